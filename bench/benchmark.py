@@ -0,0 +1,367 @@
+"""
+Offline benchmark of the recoder service.
+
+Generates synthetic MKV fixtures with ffmpeg, serves them from a local
+range capable HTTP server and runs the recoder site in-process. For each
+number of concurrent clients it measures time to first byte, throughput,
+seek latency, peak RSS and CPU time, and writes everything to a JSON file
+so runs can be compared across commits.
+
+    python bench/benchmark.py --clients 1,2,4 --output results.json
+    python bench/benchmark.py --seekable --encode-workers 2 --seek-first
+"""
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib
+import urlparse
+
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.python import usage
+from twisted.web import server, static
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.http_headers import Headers
+
+from recoder.encoder import parse_source, segment_cache
+from recoder.httpfile import chunk_cache
+from recoder.main import MainResource
+from recoder.streamingencoder import SEGMENT_TIME
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+RSS_SAMPLE_INTERVAL = 0.1
+SEEK_SIZE = 64*1024
+
+class Options(usage.Options):
+    optFlags = [
+        ['stub-ffmpeg', None, "Serve pre-encoded segments with a stand-in for ffmpeg instead of encoding"],
+        ['distinct', None, "Give every client its own stream instead of sharing one"],
+        ['seekable', None, "Remux the fixture at its cue points with Encoder instead of streaming it"],
+        ['seek-first', None, "Do the range requests before reading the stream, while it is still being encoded"],
+    ]
+    optParameters = [
+        ['ffmpeg', None, 'ffmpeg', "Path to ffmpeg"],
+        ['ffprobe', None, 'ffprobe', "Path to ffprobe"],
+        ['duration', None, '120', "Seconds of media in the fixture"],
+        ['bitrate', None, '4M', "Video bitrate of the fixture"],
+        ['audio-tracks', None, '1', "Number of audio tracks in the fixture"],
+        ['audio-bitrate', None, '640k', "Bitrate of the fixture's AC3 audio, with --seekable the 384k AAC output must not be larger"],
+        ['size', None, '1280x720', "Video size of the fixture"],
+        ['clients', None, '1,2,4,8', "Comma separated numbers of concurrent clients to run"],
+        ['seeks', None, '10', "Number of range requests each client does after reading the stream"],
+        ['stub-speed', None, '0', "Times realtime the stub ffmpeg delivers segments at, 0 for as fast as possible"],
+        ['encode-workers', None, '1', "ffmpeg processes encoding each stream in parallel, needs --seekable"],
+        ['seed', None, '0', "Seed for the seek offsets"],
+        ['fixtures', None, os.path.join(BENCH_PATH, 'fixtures'), "Folder to keep generated fixtures in"],
+        ['output', 'o', 'bench_results.json', "File to write the results to"],
+    ]
+
+def generate_fixture(options):
+    """
+    Creates an MKV with a test pattern and sine wave audio tracks, reused if
+    one with the same parameters already exists.
+    """
+    name = 'fixture-%ss-%s-%s-%sa-%s.mkv' % (options['duration'], options['bitrate'], options['size'], options['audio-tracks'], options['audio-bitrate'])
+    path = os.path.join(options['fixtures'], name)
+    if os.path.isfile(path):
+        return path
+
+    if not os.path.isdir(options['fixtures']):
+        os.makedirs(options['fixtures'])
+
+    audio_tracks = int(options['audio-tracks'])
+    cmd = [options['ffmpeg'], '-y', '-f', 'lavfi', '-i', 'testsrc=duration=%s:size=%s:rate=25' % (options['duration'], options['size'])]
+    for i in range(audio_tracks):
+        cmd += ['-f', 'lavfi', '-i', 'sine=frequency=%d:duration=%s' % (440 + i*110, options['duration'])]
+    for i in range(audio_tracks + 1):
+        cmd += ['-map', str(i)]
+    cmd += ['-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', options['bitrate'], '-g', '50',
+            '-c:a', 'ac3', '-b:a', options['audio-bitrate'], path + '.tmp.mkv']
+
+    subprocess.check_call(cmd)
+    os.rename(path + '.tmp.mkv', path)
+    return path
+
+def get_cue_times(fixture):
+    """
+    Cue times of the fixture in seconds, the points Encoder cuts segments at.
+    """
+    cues = parse_source(fixture, ['Cues'])['Cues']
+    return [Decimal(k)/1000 for k in sorted(cues.keys())]
+
+def generate_segments(options, fixture, cue_times=None):
+    """
+    Encodes the fixture the way StreamingEncoder does, or cut at cue_times the way
+    Encoder does, for the stub ffmpeg to replay.
+    """
+    segments_dir = fixture + ('.cue-segments' if cue_times else '.segments')
+    if os.path.isdir(segments_dir):
+        return segments_dir
+
+    if cue_times: # starts at 0, so the times are the same whether ffmpeg counts them from the first packet or not
+        input_args = ['-copyts', '-i', fixture]
+        segment_args = ['-segment_times', ','.join(str(cue_time) for cue_time in cue_times[1:])]
+    else:
+        input_args = ['-i', fixture]
+        segment_args = ['-segment_time', str(SEGMENT_TIME)]
+
+    os.makedirs(segments_dir + '.tmp')
+    subprocess.check_call([options['ffmpeg']] + input_args + [
+        '-sn', '-codec', 'copy', '-map', '0',
+        '-c:a', 'aac', '-strict', '-2', '-b:a', '384k',
+        '-f', 'segment', '-segment_format', 'mkv',
+    ] + segment_args + [
+        os.path.join(segments_dir + '.tmp', 'output-%05d.mkv'),
+    ])
+    os.rename(segments_dir + '.tmp', segments_dir)
+    return segments_dir
+
+def create_stub_ffmpeg(options, workdir, segments_dir, segment_time):
+    """
+    spawnProcess gives the child an empty environment, so the settings are baked into the script.
+    """
+    path = os.path.join(workdir, 'stub-ffmpeg')
+    with open(path, 'wb') as f:
+        f.write('#!%s\n' % (sys.executable, ))
+        f.write('import sys\n')
+        f.write('sys.path.insert(0, %r)\n' % (BENCH_PATH, ))
+        f.write('import stub_ffmpeg\n')
+        f.write('stub_ffmpeg.main(sys.argv[1:], %r, %r, %r)\n' % (segments_dir, float(options['stub-speed']), float(segment_time)))
+    os.chmod(path, 0755)
+    return path
+
+def get_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_cpu_time():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return {
+        'service': usage[0].ru_utime + usage[0].ru_stime,
+        'children': usage[1].ru_utime + usage[1].ru_stime,
+    }
+
+def summarize(values):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return {
+        'min': values[0],
+        'median': values[len(values) // 2],
+        'p90': values[min(int(len(values) * 0.9), len(values) - 1)],
+        'max': values[-1],
+    }
+
+class BodyReader(protocol.Protocol):
+    def __init__(self, finished):
+        self.finished = finished
+        self.first_byte = None
+        self.bytes = 0
+
+    def dataReceived(self, data):
+        if self.first_byte is None:
+            self.first_byte = time.time()
+        self.bytes += len(data)
+
+    def connectionLost(self, reason):
+        self.finished.callback(self)
+
+class Client(object):
+    """
+    Reads a stream from start to end, then does range requests at random offsets.
+    With seek_first the range requests are done first, while the stream is still encoding.
+    """
+    def __init__(self, agent, base_url, source_url, seeks, rng, seek_first=False):
+        self.agent = agent
+        self.base_url = base_url
+        self.source_url = source_url
+        self.seeks = seeks
+        self.rng = rng
+        self.seek_first = seek_first
+
+    @defer.inlineCallbacks
+    def request(self, url, headers=None):
+        response = yield self.agent.request('GET', url, Headers(headers or {}))
+        d = defer.Deferred()
+        response.deliverBody(BodyReader(d))
+        body = yield d
+        defer.returnValue((response, body))
+
+    @defer.inlineCallbacks
+    def run(self):
+        started = time.time()
+        response, body = yield self.request('%s/?url=%s' % (self.base_url, urllib.quote(self.source_url)))
+        location = response.headers.getRawHeaders('location')[0]
+        stream_url = urlparse.urljoin(self.base_url + '/', location)
+
+        seek_latency = []
+        if self.seek_first:
+            response, body = yield self.request(stream_url, {'Range': ['bytes=0-0']})
+            size = int(response.headers.getRawHeaders('content-range')[0].split('/')[1])
+            yield self.seek(stream_url, size, seek_latency)
+
+        stream_started = time.time()
+        response, body = yield self.request(stream_url)
+        finished = time.time()
+
+        if not self.seek_first:
+            yield self.seek(stream_url, body.bytes, seek_latency)
+
+        defer.returnValue({
+            'ttfb': body.first_byte - (started if not self.seek_first else stream_started) if body.first_byte else None,
+            'bytes': body.bytes,
+            'duration': finished - started,
+            'throughput': body.bytes / (finished - body.first_byte) if body.first_byte and finished > body.first_byte else None,
+            'seek_latency': seek_latency,
+        })
+
+    @defer.inlineCallbacks
+    def seek(self, stream_url, size, seek_latency):
+        for i in range(self.seeks if size > SEEK_SIZE else 0):
+            offset = self.rng.randint(0, size - SEEK_SIZE)
+            seek_started = time.time()
+            response, seek_body = yield self.request(stream_url, {'Range': ['bytes=%d-%d' % (offset, offset + SEEK_SIZE - 1)]})
+            if seek_body.first_byte:
+                seek_latency.append(seek_body.first_byte - seek_started)
+
+def clear_caches():
+    for cache in (segment_cache, chunk_cache):
+        for key in cache.keys():
+            cache.remove(key)
+
+@defer.inlineCallbacks
+def run_clients(options, ffmpeg_path, source_url, clients, workdir, rng):
+    output_folder = os.path.join(workdir, 'streams-%d' % (clients, ))
+    os.makedirs(output_folder)
+    clear_caches()
+
+    main_resource = MainResource(output_folder, ffmpeg_path, options['ffprobe'],
+                                 seekable=options['seekable'], encode_workers=int(options['encode-workers']))
+    site = server.Site(main_resource)
+    port = reactor.listenTCP(0, site, interface='127.0.0.1')
+    base_url = 'http://127.0.0.1:%d' % (port.getHost().port, )
+    agent = Agent(reactor, pool=HTTPConnectionPool(reactor, persistent=False))
+
+    peak_rss = [get_rss()]
+    def sample_rss():
+        peak_rss[0] = max(peak_rss[0], get_rss())
+    rss_sampler = task.LoopingCall(sample_rss)
+    rss_sampler.start(RSS_SAMPLE_INTERVAL)
+
+    cpu_before = get_cpu_time()
+    started = time.time()
+
+    results = yield defer.gatherResults([
+        Client(agent, base_url, source_url + ('?client=%d' % (i, ) if options['distinct'] else ''),
+               int(options['seeks']), random.Random(rng.random()), options['seek-first']).run()
+        for i in range(clients)
+    ])
+
+    duration = time.time() - started
+    cpu_after = get_cpu_time()
+    rss_sampler.stop()
+    yield port.stopListening()
+    for stream in main_resource.streams.values():
+        stream.close()
+
+    total_bytes = sum(result['bytes'] for result in results)
+    defer.returnValue({
+        'clients': clients,
+        'duration': duration,
+        'bytes': total_bytes,
+        'throughput': total_bytes / duration,
+        'ttfb': summarize([result['ttfb'] for result in results if result['ttfb'] is not None]),
+        'client_throughput': summarize([result['throughput'] for result in results if result['throughput'] is not None]),
+        'seek_latency': summarize(sum([result['seek_latency'] for result in results], [])),
+        'peak_rss': peak_rss[0],
+        'cpu_time': dict((key, cpu_after[key] - cpu_before[key]) for key in cpu_after),
+    })
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCH_PATH).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@defer.inlineCallbacks
+def run(options):
+    fixture = generate_fixture(options)
+    workdir = tempfile.mkdtemp(prefix='recoder-bench-')
+
+    ffmpeg_path = options['ffmpeg']
+    if options['stub-ffmpeg']:
+        if options['seekable']:
+            cue_times = get_cue_times(fixture)
+            segments_dir = generate_segments(options, fixture, cue_times)
+            segment_time = (cue_times[-1] - cue_times[0]) / max(len(cue_times) - 1, 1)
+        else:
+            segments_dir = generate_segments(options, fixture)
+            segment_time = SEGMENT_TIME
+        ffmpeg_path = create_stub_ffmpeg(options, workdir, segments_dir, segment_time)
+
+    source_port = reactor.listenTCP(0, server.Site(static.File(os.path.dirname(fixture))), interface='127.0.0.1')
+    source_url = 'http://127.0.0.1:%d/%s' % (source_port.getHost().port, os.path.basename(fixture))
+
+    rng = random.Random(int(options['seed']))
+    results = []
+    try:
+        for clients in [int(clients) for clients in options['clients'].split(',')]:
+            print 'Running with %d clients' % (clients, )
+            result = yield run_clients(options, ffmpeg_path, source_url, clients, workdir, rng)
+            print json.dumps(result, indent=2)
+            results.append(result)
+    finally:
+        yield source_port.stopListening()
+        shutil.rmtree(workdir, True)
+
+    with open(options['output'], 'wb') as f:
+        json.dump({
+            'commit': get_commit(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'options': dict(options),
+            'fixture': {
+                'name': os.path.basename(fixture),
+                'size': os.path.getsize(fixture),
+            },
+            'results': results,
+        }, f, indent=2)
+
+    print 'Results written to %s' % (options['output'], )
+
+def main():
+    options = Options()
+    options.parseOptions()
+
+    exit_code = []
+    def failed(reason):
+        reason.printTraceback(sys.stderr)
+        exit_code.append(1)
+
+    def start():
+        d = run(options)
+        d.addErrback(failed)
+        d.addBoth(lambda ignored: reactor.stop())
+
+    reactor.callWhenRunning(start)
+    reactor.run()
+    sys.exit(exit_code and 1 or 0)
+
+if __name__ == '__main__':
+    main()
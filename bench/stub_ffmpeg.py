@@ -0,0 +1,57 @@
+"""
+Stand-in for ffmpeg when benchmarking the service instead of the encoder.
+
+Copies segments made up front with the real ffmpeg into the output pattern at
+a fixed speed, reporting them on the segment list and progress pipes the same
+way ffmpeg does. Only the arguments StreamingEncoder and Encoder use are understood:
+a StreamingEncoder run (-segment_time) gets every segment, an Encoder job gets the
+segments from -segment_start_number on, one more than it has -segment_times.
+The segments must have been cut at the same points, -ss and -to are not looked at.
+"""
+import os
+import shutil
+import sys
+import time
+
+def get_arg(args, name, default=None):
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+def main(args, segments_dir, speed, segment_time):
+    output_pattern = args[-1]
+    segment_number = int(get_arg(args, '-segment_start_number', 0))
+    filenames = sorted(filename for filename in os.listdir(segments_dir) if filename.endswith('.mkv'))
+    if '-segment_time' not in args: # an Encoder job, cut at the cue points
+        segment_times = get_arg(args, '-segment_times')
+        segment_count = len(segment_times.split(',')) + 1 if segment_times else 1
+        filenames = filenames[segment_number:segment_number + segment_count]
+    progress = None
+    if get_arg(args, '-progress') == 'pipe:3':
+        progress = os.fdopen(3, 'w')
+
+    started = time.time()
+    out_time = 0
+    for filename in filenames:
+        out_time += segment_time
+        if speed:
+            time.sleep(max(started + out_time / speed - time.time(), 0))
+
+        output = output_pattern % segment_number
+        shutil.copyfile(os.path.join(segments_dir, filename), output)
+        segment_number += 1
+
+        sys.stdout.write(os.path.basename(output) + '\n')
+        sys.stdout.flush()
+
+        if progress is not None:
+            progress.write('out_time_us=%d\nspeed=%.2fx\nprogress=continue\n' % (
+                out_time * 1000000, out_time / max(time.time() - started, 0.001)))
+            progress.flush()
+
+    if progress is not None:
+        progress.write('progress=end\n')
+        progress.close()
+
+if __name__ == '__main__':
+    main(sys.argv[4:], sys.argv[1], float(sys.argv[2]), float(sys.argv[3]))
@@ -0,0 +1,135 @@
+import threading
+
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+class LRUCache(object):
+    """
+    A thread-safe LRU cache with a budget in bytes instead of number of items.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.items[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size):
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+
+            if size > self.max_size:
+                return
+
+            self.items[key] = (value, size)
+            self.size += size
+            self._evict()
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+
+    def set_max_size(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size:
+            key, (value, size) = self.items.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def keys(self):
+        with self.lock:
+            return list(self.items.keys())
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'items': len(self.items),
+                'size': self.size,
+                'max_size': self.max_size,
+            }
+
+class DeferredCache(LRUCache):
+    """
+    An LRU cache for values loaded asynchronously in the reactor thread.
+    Concurrent misses for the same key share a single load, a load still
+    running when its key is removed is not stored.
+    """
+    def __init__(self, max_size):
+        LRUCache.__init__(self, max_size)
+        self.loading = {}
+        self.shared_loads = 0
+
+    def get_or_load(self, key, load_function, *args, **kwargs):
+        value = self.get(key)
+        if value is not None:
+            return defer.succeed(value)
+
+        if key in self.loading:
+            self.shared_loads += 1
+            d = defer.Deferred()
+            self.loading[key].append(d)
+            return d
+
+        waiting = self.loading[key] = []
+
+        def loaded(value):
+            if self.loading.get(key) is waiting:
+                del self.loading[key]
+                self.set(key, value, len(value))
+            for d in waiting:
+                d.callback(value)
+            return value
+
+        def failed(reason):
+            if self.loading.get(key) is waiting:
+                del self.loading[key]
+            for d in waiting:
+                d.errback(reason)
+            return reason
+
+        return defer.maybeDeferred(load_function, *args, **kwargs).addCallbacks(loaded, failed)
+
+    def remove(self, key):
+        LRUCache.remove(self, key)
+        self.loading.pop(key, None) # whoever waits for it still gets it
+
+    def keys(self):
+        return list(set(LRUCache.keys(self)) | set(self.loading))
+
+    def get_stats(self):
+        stats = LRUCache.get_stats(self)
+        stats['loading'] = len(self.loading)
+        stats['shared_loads'] = self.shared_loads
+        return stats
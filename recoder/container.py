@@ -1,114 +1,174 @@
-from StringIO import StringIO
+import heapq
+import itertools
+
+from bisect import bisect_right
 
 from twisted.internet import defer
 
+class StringElement(object):
+    """
+    Element with data known up front, e.g. synthesized headers.
+    """
+    def __init__(self, data):
+        self.data = str(data)
+
+    def get_data(self):
+        return self.data
+
+class LazyElement(object):
+    """
+    Element where the data is fetched when a reader needs it.
+    """
+    def __init__(self, data_fetch_function, size):
+        self.data_fetch_function = data_fetch_function
+        self.size = size
+
+    def get_data(self):
+        return defer.maybeDeferred(self.data_fetch_function)
+
 class FileContainer(object):
-    waiting_for_element = None
-    parent = None
-    
+    """
+    Append-only table of elements shared by all readers of a file.
+    """
+    reader_moved = None # called when a reader moves to another element or goes away
+
     def __init__(self):
         self.elements = []
-        self.position = 0
+        self.offsets = [] # start offset of each element, sorted as elements are appended. Not an array('L'), that overflows at 4 GiB where long is 32 bits
         self.size = 0
-        self.current_index = 0
         self.done = False
-        self.new_element_added = defer.Deferred()
-        self.children = []
+        self.waiters = [] # heap of (offset, sequence, deferred)
+        self.waiter_sequence = itertools.count()
+        self.readers = set()
+        self.bytes_read = 0 # by all readers
+
+    def wait_for_offset(self, offset):
+        """
+        Returns a Deferred that fires when the byte at offset is available
+        or when no more elements will be added.
+        """
+        if offset < self.size or self.done:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        heapq.heappush(self.waiters, (offset, next(self.waiter_sequence), d))
+        return d
+
+    def _wake_waiters(self):
+        ready = []
+        while self.waiters and (self.done or self.waiters[0][0] < self.size):
+            ready.append(heapq.heappop(self.waiters)[2])
+
+        for d in ready:
+            d.callback(None)
+
+    def write_element(self, element, size):
+        self.elements.append(element)
+        self.offsets.append(self.size)
+        self.size += size
+        self._wake_waiters()
+
+    def finish(self):
+        """
+        Marks the container as complete, no more elements will be written.
+        """
+        self.done = True
+        self._wake_waiters()
+
+    def get_size(self):
+        if self.done:
+            return self.size
+        else:
+            return 0
+
+    def get_furthest_reader_index(self):
+        """
+        Index of the furthest element any reader is at, -1 if there are no readers.
+        """
+        return max([reader.current_index for reader in self.readers] or [-1])
+
+    def get_slowest_reader_index(self):
+        """
+        Index of the element the reader furthest behind is at, None if there are no readers.
+        """
+        if not self.readers:
+            return None
+        return min(reader.current_index for reader in self.readers)
+
+    def _reader_moved(self):
+        if self.reader_moved is not None:
+            self.reader_moved()
+
+    def copy(self):
+        return ContainerReader(self)
+
+class ContainerReader(object):
+    """
+    A cursor into a FileContainer, only the position and the data of
+    the current element belongs to the reader.
+    """
+    def __init__(self, container):
+        self.container = container
+        self.position = 0
+        self.current_index = 0
+        self.current_data = None
+        container.readers.add(self)
 
     def tell(self):
         return self.position
 
-    @defer.inlineCallbacks
     def seek(self, position):
         self.position = position
-        last_size = 0
-        last_element = None
-
-        for index, (size, element) in enumerate(self.elements):
-            if size > position:
-                break
+        self.current_index = max(bisect_right(self.container.offsets, position) - 1, 0)
+        self.container._reader_moved()
 
-            last_element = element
-            last_size = size
-        else:
-            last_element = element
-            last_size = size
-            index += 1
-
-        if last_element is None:
-            defer.returnValue()
-        
-        self.current_index = index - 1
-        
-        self.waiting_for_element = defer.maybeDeferred(last_element.seek, position-last_size)
-        yield self.waiting_for_element
-        self.waiting_for_element = None
+    @defer.inlineCallbacks
+    def _get_element_data(self, index):
+        if self.current_data is None or self.current_data[0] != index:
+            self.current_data = None
+            data = yield defer.maybeDeferred(self.container.elements[index].get_data)
+            self.current_data = (index, data)
 
-    def write_element(self, element, size):
-        self.elements.append((self.size, element))
-        self.size += size
-        self.new_element_added.callback(None)
-        self.new_element_added = defer.Deferred()
-        
-        for child in self.children:
-            child.write_element(self._get_element_copy(element), size)
+        defer.returnValue(self.current_data[1])
 
     @defer.inlineCallbacks
     def read(self, size=4096):
-        if self.waiting_for_element is not None:
-            yield self.waiting_for_element
-        
-        retval = ''
+        container = self.container
+
+        chunks = []
         while size:
-            if len(self.elements) <= self.current_index:
-                break
-            
-            element = self.elements[self.current_index][1]
-            data = yield defer.maybeDeferred(element.read, size)
-            
-            if not data:
-                break
+            if self.position >= container.size:
+                if chunks or container.done:
+                    break
+
+                yield container.wait_for_offset(self.position) # there will be new elements added soon
+                continue
 
-            if len(data) < size:
+            index = self.current_index
+            if index + 1 < len(container.offsets) and container.offsets[index+1] <= self.position:
                 self.current_index += 1
-                element.close()
-            
-            retval += data
+                container._reader_moved()
+                continue
+
+            data = yield self._get_element_data(index)
+            start = self.position - container.offsets[index]
+            data = data[start:start+size]
+
+            if not data: # element is shorter than it claimed to be
+                break
+
+            chunks.append(data)
+            container.bytes_read += len(data)
+            self.position += len(data)
             size -= len(data)
-            
-        self.position += len(retval)
-        
-        if retval == '' and size and not self.done: # there will be new elements added soon
-            yield self.new_element_added
-            if not self.done:
-                retval += yield self.read(size)
 
-        defer.returnValue(retval)
+        defer.returnValue(''.join(chunks))
 
     def get_size(self):
-        if self.done:
-            return self.size
-        else:
-            return 0
-    
+        return self.container.get_size()
+
     def close(self):
-        if self.parent and self in self.parent.children:
-            self.parent.children.remove(self)
-    
-    def _get_element_copy(self, element):
-        if isinstance(element, StringIO):
-            element = StringIO(element.buf)
-        else:
-            element = element.copy()
-        return element
-    
-    def copy(self):
-        fc = FileContainer()
-        self.children.append(fc)
-        
-        for size, element in self.elements:
-            element = self._get_element_copy(element)
-            fc.elements.append((size, element))
-        
-        fc.size = self.size
-        return fc
+        self.current_data = None
+        if self in self.container.readers:
+            self.container.readers.discard(self)
+            self.container._reader_moved()
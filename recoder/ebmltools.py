@@ -165,6 +165,8 @@ def extract_cuedata(segmentelement, offset):
             break
 
         for cuepos in element.value:
+            if cuepos.name != 'CuePoint': # e.g. CRC-32 written by newer ffmpeg
+                continue
             element_values = {'CueTime': None, 'CueTrackPositions': None}
             for value in cuepos.value:
                 element_values[value.name] = value.value
@@ -183,7 +185,9 @@ def extract_parts(segmentelement, parts):
         raise NoUsefulInfoFoundException('First element name is not SeekHead, it is %r' % seekhead.name)
 
     for element in seekhead.value:
-        element_id, seekposition = [x.value for x in element.value]
+        if element.name != 'Seek': # e.g. CRC-32 written by newer ffmpeg
+            continue
+        element_id, seekposition = [x.value for x in element.value if x.name in ('SeekID', 'SeekPosition')]
         if element_id == encode_element_id(get_element('Segment').id) and 'Segment' in parts: # '\x15\x49\xa9\x66'
             retval['Segment'] = get_segment_iter(segmentelement, seekposition)
         elif element_id == encode_element_id(get_element('Tracks').id) and 'Tracks' in parts: # '\x16\x54\xae\x6b'
@@ -1,34 +1,129 @@
+import itertools
 import json
 import os
+import shutil
+import tempfile
+import time
 
+from bisect import bisect_right
 from collections import defaultdict
 from decimal import Decimal
 from functools import partial
-from StringIO import StringIO
 
 from ebml.schema.matroska import MatroskaDocument
 
-from twisted.internet import defer, protocol, reactor, task, threads, utils
+from twisted.internet import defer, error, protocol, reactor, threads, utils
+from twisted.python import log
 
-from .container import FileContainer
-from .ebmltools import create_cues_element, create_ebml_header, create_info_element, create_seek_element, create_segment_header_element, create_void, extract_parts
+from .cache import DeferredCache
+from .container import FileContainer, LazyElement, StringElement
+from .ebmltools import create_cues_element, create_ebml_header, create_info_element, create_seek_element, create_segment_header_element, create_void, extract_parts, NoUsefulInfoFoundException
 from .httpfile import HttpFile
+from .localfile import LocalFile, get_local_path
+from .scheduler import scheduler
+from .threadpools import defer_to_io_pool, defer_to_probe_pool
 
 CUE_OFFSET = 50000 # padding to the cue table to make sure there is room (better safe than sorry)
 OUTPUT_FORMAT = 'output-%05d.mkv'
+INDEX_SUFFIX = '.idx' # cluster byte ranges saved next to each segment
+SEGMENT_CACHE_SIZE = 256*1024*1024
+SOURCE_READAHEAD = 4 # number of chunks to prefetch while parsing the source
+RESTART_WAIT_THRESHOLD = 20 # seconds a reader is expected to wait for a segment before we encode from there instead
+RESTART_SEGMENT_DISTANCE = 3 # segments ahead of the encode to restart at when we have no encode speed yet
+RESTART_RUN_SEGMENTS = 30 # max segments to encode after a restart when other readers wait elsewhere
+PROGRESS_LOG_INTERVAL = 30 # seconds between logging the progress of each ffmpeg process
+PROGRESS_ARGS = ['-progress', 'pipe:3', '-nostats'] # machine readable progress on fd 3
+PROGRESS_FDS = {0: 'w', 1: 'r', 2: 'r', 3: 'r'}
+PROGRESS_KEYS = ['out_time_us', 'out_time_ms', 'speed', 'bitrate', 'frame', 'total_size']
+SEGMENT_TIMES_PROBE_ARGS = [ # a stream starting at 10s cut at 1s and 12s
+    '-v', 'error', '-copyts', '-itsoffset', '10', '-f', 'lavfi', '-i', 'color=size=16x16:rate=2:duration=4',
+    '-c:v', 'rawvideo', '-f', 'segment', '-segment_format', 'nut',
+    '-segment_list', 'pipe:1', '-segment_list_type', 'flat', '-segment_times', '1,12',
+]
+
+segment_cache = DeferredCache(SEGMENT_CACHE_SIZE) # wrapped segments shared by all readers, keyed by (output path, segment id)
+segment_times_relative = {} # ffmpeg path -> if it counts -segment_times from the first packet
+
+def parse_progress_value(key, value):
+    """
+    Turns a value from ffmpeg's progress output into a number, None if unknown.
+    """
+    try:
+        if key in ('out_time_us', 'out_time_ms'): # both are in microseconds
+            return int(value) / 1000000.0
+        if key == 'speed':
+            return float(value.rstrip('x'))
+        if key == 'bitrate':
+            return float(value.replace('kbits/s', ''))
+        if key in ('frame', 'total_size'):
+            return int(value)
+    except ValueError:
+        return None
+    return value
 
 class FFMpegPP(protocol.ProcessProtocol):
-    def __init__(self):
+    last_progress_log = 0
+    
+    def __init__(self, segment_completed=None, progress_received=None):
         self.finished = defer.Deferred()
+        self.segment_completed = segment_completed
+        self.progress_received = progress_received
+        self.out_buffer = ''
+        self.progress_buffer = ''
+        self.progress = {} # out_time (seconds), speed (x realtime), bitrate (kbit/s) from the latest progress report
+        self.pending_progress = {}
     
     def connectionMade(self):
         print "connectionMade!"
 
-    def outReceived(self, data):
-        pass
-        #print "outReceived! with %d bytes!" % len(data)
-        #print data
+    def outReceived(self, data): # ffmpeg writes the segment list here, one filename per finished segment
+        self.out_buffer += data
+        lines = self.out_buffer.split('\n')
+        self.out_buffer = lines.pop()
+        
+        for line in lines:
+            line = line.strip()
+            if line and self.segment_completed is not None:
+                self.segment_completed(line)
 
+    def childDataReceived(self, childFD, data):
+        if childFD == 3:
+            self.progressReceived(data)
+        else:
+            protocol.ProcessProtocol.childDataReceived(self, childFD, data)
+    
+    def progressReceived(self, data): # ffmpeg writes blocks of key=value lines here, each ending with progress=
+        self.progress_buffer += data
+        lines = self.progress_buffer.split('\n')
+        self.progress_buffer = lines.pop()
+        
+        for line in lines:
+            if '=' not in line:
+                continue
+            
+            key, value = [part.strip() for part in line.split('=', 1)]
+            if key == 'progress': # end of a block
+                self.progress_updated(self.pending_progress)
+                self.pending_progress = {}
+            elif key in PROGRESS_KEYS:
+                value = parse_progress_value(key, value)
+                if key.startswith('out_time'):
+                    key = 'out_time'
+                self.pending_progress[key] = value
+    
+    def progress_updated(self, progress):
+        self.progress.update((key, value) for key, value in progress.items() if value is not None)
+        
+        if self.progress_received is not None:
+            self.progress_received(self.progress)
+        
+        now = time.time()
+        if now - self.last_progress_log >= PROGRESS_LOG_INTERVAL:
+            self.last_progress_log = now
+            log.msg('ffmpeg %s at %ss, speed %sx, bitrate %skbit/s' % (
+                getattr(self.transport, 'pid', None), self.progress.get('out_time'),
+                self.progress.get('speed'), self.progress.get('bitrate')))
+    
     def errReceived(self, data):
         pass
         #print "errReceived! with %d bytes!" % len(data)
@@ -45,107 +140,307 @@ class FFMpegPP(protocol.ProcessProtocol):
 
     def processExited(self, reason):
         self.processEnded(reason)
-        print "processExited, status %d" % (reason.value.exitCode,)
+        print "processExited, status %s" % (reason.value.exitCode,)
 
     def processEnded(self, reason):
         if not self.finished.called:
             if reason.value.exitCode == 0:
                 self.finished.callback(None)
             else:
-                self.finished.errback(None)
+                self.finished.errback(reason)
         
-        print "processEnded, status %d" % (reason.value.exitCode,)
+        print "processEnded, status %s" % (reason.value.exitCode,)
 
-def wrap_segment(filepath, expected_size):
+def parse_source(url, parts, source_cache=None):
+    """
+    Fetches and parses the parts of the source file needed to build the output.
+    This blocks and must not run in the reactor thread.
+    """
+    local_path = get_local_path(url)
+    if local_path is not None:
+        f = LocalFile(local_path)
+    else:
+        f = HttpFile(url, readahead=SOURCE_READAHEAD, source_cache=source_cache)
+    
+    try:
+        doc = MatroskaDocument(f)
+        segment = doc.roots[1]
+        info = extract_parts(segment, parts=parts)
+        info['Size'] = segment.size
+    finally:
+        if local_path is not None: # also when the source cannot be used, it is streamed instead
+            f.close()
+    
+    return info
+
+def index_segment(filepath):
+    """
+    Finds the byte ranges of the clusters in a segment and saves them next to it
+    so serving the segment does not need to parse it again.
+    """
+    ranges = []
     with open(filepath, 'rb') as f:
         doc = MatroskaDocument(f)
         s = doc.roots[1]
-        retval = ''
         for element in s.value:
             if element.name == 'Cluster':
-                element.stream.seek(0)
-                retval += element.stream.read(element.size)
-        retval += create_void(expected_size - len(retval))
+                offset, size = element.stream.offset, element.size
+                if ranges and sum(ranges[-1]) == offset: # merge with the previous cluster
+                    ranges[-1][1] += size
+                else:
+                    ranges.append([offset, size])
     
-    return StringIO(retval)
+    index_path = filepath + INDEX_SUFFIX
+    with open(index_path + '.tmp', 'wb') as f:
+        json.dump(ranges, f)
+    os.rename(index_path + '.tmp', index_path)
+    
+    return ranges
 
-class LazyStringIO(object):
-    data = None
-    data_setting_defer = None
+def get_segment_index(filepath):
+    try:
+        with open(filepath + INDEX_SUFFIX, 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return index_segment(filepath)
 
-    def __init__(self, data_fetch_function, size):
-        self.data_fetch_function = data_fetch_function
-        self.size = size
+class SegmentData(object):
+    """
+    The served data of a finished segment. Each cluster range is read once and kept
+    as its own string, together with the void padding, so the segment is never joined
+    into one big copy. No file is kept open, this blocks while reading.
+    """
+    def __init__(self, filepath, ranges, expected_size):
+        self.starts = [] # where each cluster range starts in the served data
+        self.regions = [] # data of each cluster range
+        
+        position = 0
+        with open(filepath, 'rb') as f:
+            for offset, size in ranges:
+                f.seek(offset)
+                self.starts.append(position)
+                self.regions.append(f.read(size))
+                position += size
+        
+        self.cluster_size = position
+        self.padding = str(create_void(expected_size - position))
+        self.size = position + len(self.padding)
+    
+    def __len__(self):
+        return self.size
+    
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        
+        retval = []
+        index = bisect_right(self.starts, start) - 1
+        while index >= 0 and index < len(self.starts) and start < min(stop, self.cluster_size):
+            region = self.regions[index]
+            region_start = start - self.starts[index]
+            region_stop = min(stop - self.starts[index], len(region))
+            retval.append(region[region_start:region_stop])
+            start += region_stop - region_start
+            index += 1
+        
+        if start < stop:
+            retval.append(self.padding[start-self.cluster_size:stop-self.cluster_size])
+        
+        return ''.join(retval)
 
-    @defer.inlineCallbacks
-    def set_data(self):
-        if self.data_setting_defer is not None:
-            yield self.data_setting_defer
-        else:
-            self.data_setting_defer = defer.Deferred()
-            self.data = yield defer.maybeDeferred(self.data_fetch_function)
-            self.data_setting_defer.callback(None)
-            self.data_setting_defer = None
+def wrap_segment(filepath, expected_size):
+    return SegmentData(filepath, get_segment_index(filepath), expected_size)
 
-    @defer.inlineCallbacks
-    def read(self, size=1024):
-        if self.data is None:
-            yield self.set_data()
-        defer.returnValue(self.data.read(size))
+def read_segment_parts(filepath, parts):
+    with open(filepath, 'rb') as f:
+        doc = MatroskaDocument(f)
+        segment = doc.roots[1]
+        return extract_parts(segment, parts=parts)
+
+def store_segment(filepath, result_file):
+    """
+    Moves a finished segment into place and indexes it, returns the size of it
+    or None if it is already gone.
+    """
+    if not os.path.isfile(filepath):
+        return None
+    
+    os.rename(filepath, result_file)
+    index_segment(result_file)
+    return os.path.getsize(result_file)
+
+def remove_file(filepath):
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
 
+def create_folder(path):
+    if not os.path.isdir(path):
+        os.mkdir(path)
+
+def list_folder(path):
+    """
+    Sorted filenames in path, empty if it does not exist (yet).
+    """
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
+
+@defer.inlineCallbacks
+def is_segment_times_relative(ffmpeg_path):
+    """
+    Older ffmpeg compares -segment_times to the packet timestamps, newer counts
+    them from the first packet. Found out once per ffmpeg by cutting a stream
+    starting at 10s, counted from the first packet that makes two segments
+    and compared to the timestamps three.
+    """
+    if ffmpeg_path not in segment_times_relative:
+        temp_path = yield defer_to_io_pool(tempfile.mkdtemp, prefix='recoder-')
+        try:
+            output = yield utils.getProcessOutput(ffmpeg_path, SEGMENT_TIMES_PROBE_ARGS + [os.path.join(temp_path, 'probe-%d.nut')])
+            segment_times_relative[ffmpeg_path] = len(output.split()) == 2
+        except (IOError, OSError):
+            log.err(None, 'Failed to find out how %s cuts segments, assuming it compares timestamps' % (ffmpeg_path, ))
+            segment_times_relative[ffmpeg_path] = False
+        finally:
+            yield defer_to_io_pool(shutil.rmtree, temp_path, True)
+    
+    defer.returnValue(segment_times_relative[ffmpeg_path])
+
+class EncodeJob(object):
+    """
+    A single ffmpeg process encoding the segments from start_segment_id to
+    end_segment_id into its own temporary folder.
+    """
+    process = None
+    started = None # when the ffmpeg process was started
+    stopped = False
+    
+    def __init__(self, encoder, start_segment_id, end_segment_id, temp_output_path):
+        self.encoder = encoder
+        self.start_segment_id = start_segment_id
+        self.end_segment_id = end_segment_id
+        self.temp_output_path = temp_output_path
+        self.head = start_segment_id - 1 # last segment finished
+        self.encoded_duration = 0 # seconds of media encoded
+    
     @defer.inlineCallbacks
-    def seek(self, offset, whence=os.SEEK_SET):
-        if self.data is None:
-            yield self.set_data()
+    def start(self, cmd):
+        self.process = FFMpegPP(self.segment_completed)
         
-        self.data.seek(offset, whence)
-
-    def tell(self):
-        if self.data is None:
-            self.set_data()
+        yield defer_to_io_pool(create_folder, self.temp_output_path)
+        if self.stopped: # killed before it got to start
+            yield self.encoder.clean_temp_output_folder(self)
+            return
+        
+        def spawned(wait_time):
+            self.started = time.time()
+        
+        scheduler.spawn(self.process, cmd, partial(self.encoder._count_waiting, self), childFDs=PROGRESS_FDS).addCallback(spawned)
+        
+        def done_encoding(ignored):
+            if not self.stopped:
+                self.encoder.stop_encoding(successful=True, job=self)
+        
+        def failed_encoding(reason):
+            if not self.stopped: # we did not kill it ourselves
+                self.encoder.stop_encoding(job=self)
         
-        self.data.tell()
+        self.process.finished.addCallbacks(done_encoding, failed_encoding)
     
-    def close(self):
-        self.data = None
+    def kill(self):
+        self.stopped = True
+        if scheduler.cancel(self.process) or self.process.transport is None: # never got to run
+            return
+        
+        try:
+            self.process.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
     
-    def copy(self):
-        return LazyStringIO(self.data_fetch_function, self.size)
+    def segment_completed(self, filename):
+        self.encoder.segment_completed(filename, self)
+    
+    def segment_moved(self, segment_id, duration):
+        if segment_id > self.head:
+            self.encoded_duration += duration
+            self.head = segment_id
+    
+    def covers(self, segment_id):
+        """
+        If this job will still produce segment_id.
+        """
+        return self.head < segment_id <= self.end_segment_id
+    
+    def get_speed(self):
+        """
+        Seconds of media encoded per second, None if unknown.
+        """
+        if self.process is not None and self.process.progress.get('speed'):
+            return self.process.progress['speed']
+        
+        if self.started is None or not self.encoded_duration:
+            return None
+        
+        return self.encoded_duration / max(time.time() - self.started, 0.001)
 
 class Encoder(object): # must always seperate subs / no room for custom fonts etc.
     format = None
     segment_count = None # number of segments, last id will be <this>-1
     file_info = None
+    cue_times = None
+    segment_times_relative = False # this ffmpeg counts -segment_times from the first packet
     
-    move_timer = None
     ffmpeg_process = None
+    closed = False
+    blocked_time = 0 # seconds readers have waited for segments to be loaded or encoded
+    workers = 1 # default number of ffmpeg processes encoding a stream in parallel
     
     base_container = None
     
-    def __init__(self, url, output_path, ffmpeg_path, ffprobe_path):
+    def __init__(self, url, output_path, ffmpeg_path, ffprobe_path, source_caches=None, workers=None):
         self.url = url
+        if workers:
+            self.workers = workers
+        self.local_path = get_local_path(url)
+        self.source_caches = source_caches
         self.ffmpeg_path = ffmpeg_path
         self.ffprobe_path = ffprobe_path
         self.output_path = output_path
         self.temp_output_path = os.path.join(output_path, 'encoding')
         
-        self.move_timer = task.LoopingCall(self.check_for_files_to_move)
-        
         self.container_defers = []
         self.segment_created_defers = dict()
-        
-        if not os.path.isdir(self.temp_output_path):
-            os.mkdir(self.temp_output_path)
+        self.failed_segments = set() # segments ffmpeg did not produce even though it was started there
+        self.segment_sizes = {} # size on disk of each finished segment
+        self.segment_access = {} # when each segment was last read
+        self.evicted_segments = set() # segments removed from disk, only encoded again when read
+        self.segment_removals = {} # segment id -> Deferred removing the files of an evicted segment
+        self.jobs = []
+        self.job_ids = itertools.count()
+        self.move_lock = defer.DeferredLock() # segments are moved one at a time, in the order ffmpeg finished them
         
         self.streams = defaultdict(list)
     
+    @property
+    def input_url(self):
+        """
+        The url ffmpeg and ffprobe should read the source from.
+        """
+        if self.local_path is not None:
+            return 'file:' + self.local_path
+        if self.source_caches is None:
+            return self.url
+        return self.source_caches.get_proxy_url(self.url)
+    
     def _get_ffprobe_output(self):
         return utils.getProcessOutput(self.ffprobe_path, args=[
             '-print_format', 'json',
             '-loglevel', 'quiet',
             '-show_format',
             '-show_streams',
-            self.url,
+            self.input_url,
         ])
     
     @defer.inlineCallbacks
@@ -164,18 +459,134 @@ class Encoder(object): # must always seperate subs / no room for custom fonts et
         
         self.build_container()
     
+    def get_duration(self):
+        """
+        Duration of the source in seconds.
+        """
+        if self.format and 'duration' in self.format:
+            return float(self.format['duration'])
+        
+        timecodescale, duration = 1000000, 0
+        for element in self.file_info['Info']:
+            if element.name == 'TimecodeScale':
+                timecodescale = element.value
+            elif element.name == 'Duration':
+                duration = element.value
+        
+        return float(duration) * timecodescale / 1000000000
+    
+    def get_segment_duration(self, segment_id):
+        if segment_id + 1 < len(self.cue_times):
+            end = float(self.cue_times[segment_id+1])
+        else:
+            end = self.get_duration()
+        return max(end - float(self.cue_times[segment_id]), 0)
+    
+    def get_encode_speed(self):
+        """
+        Seconds of media encoded per second by all ffmpeg processes, None if unknown.
+        """
+        speeds = [job.get_speed() for job in self.jobs if job.get_speed() is not None]
+        if not speeds:
+            return None
+        
+        return sum(speeds)
+    
+    def get_encode_head(self):
+        """
+        The furthest segment finished by a running encode, or on disk if nothing is encoding.
+        """
+        if self.jobs:
+            return max(job.head for job in self.jobs)
+        return max(self.segment_sizes.keys() or [-1])
+    
+    def get_job(self, segment_id):
+        for job in self.jobs:
+            if job.covers(segment_id):
+                return job
+        return None
+    
     def estimate_if_should_encode_from_elsewhere(self, segment_id):
         """
         Sometimes we will need to kill the re-encode and start elsewhere, e.g. if a client seeks.
         
         This function will try to guess if we should wait or restart
         """
-        pass
+        job = self.get_job(segment_id)
+        if job is None: # no encode will ever reach it
+            return True
+        
+        speed = job.get_speed()
+        if speed is None:
+            return segment_id - job.head > RESTART_SEGMENT_DISTANCE
+        
+        duration_to_encode = float(self.cue_times[segment_id]) - float(self.cue_times[job.head+1])
+        return duration_to_encode / speed > RESTART_WAIT_THRESHOLD
+    
+    def _segment_exists(self, segment_id):
+        return segment_id in self.segment_sizes
+    
+    def _segment_taken(self, segment_id):
+        return self._segment_exists(segment_id) or self.get_job(segment_id) is not None
+    
+    def _count_waiting(self, job):
+        return len([segment_id for segment_id in self.segment_created_defers if job.covers(segment_id)])
+    
+    def encode_from(self, segment_id):
+        """
+        Starts an encode at segment_id, stopping before the next segment that is already
+        encoded or being encoded. If all workers are busy, the one covering segment_id
+        or the one with fewest waiting readers is stopped.
+        """
+        if len(self.jobs) >= self.workers:
+            job = self.get_job(segment_id)
+            if job is None:
+                job = min(self.jobs, key=self._count_waiting)
+            self.stop_encoding(job=job)
+        
+        end_segment_id = segment_id
+        while end_segment_id + 1 < len(self.cue_times) and not self._segment_taken(end_segment_id + 1):
+            end_segment_id += 1
+        
+        for waiting_segment_id in self.segment_created_defers: # make sure we get back to readers waiting elsewhere
+            if not segment_id <= waiting_segment_id <= end_segment_id and not self._segment_taken(waiting_segment_id):
+                end_segment_id = min(end_segment_id, segment_id + RESTART_RUN_SEGMENTS - 1)
+                break
+        
+        self.start_encoding(segment_id, end_segment_id)
+    
+    def encode_next_missing(self):
+        """
+        Fill the free workers with the segments readers wait for, then the first missing segments.
+        """
+        for segment_id in sorted(self.segment_created_defers) + range(len(self.cue_times)):
+            if len(self.jobs) >= self.workers:
+                break
+            
+            if segment_id in self.evicted_segments and segment_id not in self.segment_created_defers:
+                continue
+            
+            if segment_id not in self.failed_segments and not self._segment_taken(segment_id):
+                self.encode_from(segment_id)
     
     def get_segment(self, segment_id, expected_size):
+        self.segment_access[segment_id] = time.time()
+        d = segment_cache.get_or_load((self.output_path, segment_id), self._load_segment, segment_id, expected_size)
+        
+        if not d.called:
+            started = time.time()
+            
+            def segment_loaded(result):
+                self.blocked_time += time.time() - started
+                return result
+            d.addBoth(segment_loaded)
+        
+        return d
+    
+    def _load_segment(self, segment_id, expected_size):
         filepath = os.path.join(self.output_path, OUTPUT_FORMAT % segment_id)
-        if os.path.isfile(filepath):
-            return defer.succeed(wrap_segment(filepath, expected_size))
+        if self._segment_exists(segment_id):
+            return defer_to_io_pool(wrap_segment, filepath, expected_size)
         else: # check if we need to cancel our encode and start elsewhere
             if segment_id not in self.segment_created_defers:
                 self.segment_created_defers[segment_id] = []
@@ -184,9 +595,12 @@ class Encoder(object): # must always seperate subs / no room for custom fonts et
             self.segment_created_defers[segment_id].append(d)
             
             def make_wrap_segment(ignored):
-                return defer.succeed(wrap_segment(filepath, expected_size))
+                return defer_to_io_pool(wrap_segment, filepath, expected_size)
             d.addCallback(make_wrap_segment)
             
+            if self.estimate_if_should_encode_from_elsewhere(segment_id):
+                self.encode_from(segment_id)
+            
             return d
     
     def get_container(self):
@@ -238,7 +652,7 @@ class Encoder(object): # must always seperate subs / no room for custom fonts et
         
         self.filesize = len(ebml_header_element) + segment_size + segment_header_size
         container = FileContainer()
-        container.write_element(StringIO(cluster_start), len(cluster_start))
+        container.write_element(StringElement(cluster_start), len(cluster_start))
         
         last_size = None
         i = 0
@@ -246,16 +660,17 @@ class Encoder(object): # must always seperate subs / no room for custom fonts et
             v += CUE_OFFSET
             if last_size is not None:
                 size = v-last_size
-                container.write_element(LazyStringIO(partial(self.get_segment, i, size), size), size)
+                container.write_element(LazyElement(partial(self.get_segment, i, size), size), size)
                 i += 1
             last_size = v
         
         size = segment_size-last_size
-        container.write_element(LazyStringIO(partial(self.get_segment, i, size), size), size)
-        container.done = True
+        container.write_element(LazyElement(partial(self.get_segment, i, size), size), size)
+        container.finish()
         
         self.base_container = container
-        for d in self.container_defers:
+        container_defers, self.container_defers = self.container_defers, []
+        for d in container_defers:
             d.callback(self.base_container.copy())
     
     @defer.inlineCallbacks
@@ -263,13 +678,8 @@ class Encoder(object): # must always seperate subs / no room for custom fonts et
         if self.file_info is not None and 'Tracks' in self.file_info:
             return
         
-        with open(filepath, 'rb') as f:
-            doc = MatroskaDocument(f)
-            segment = doc.roots[1]
-            
-            info = yield threads.deferToThread(extract_parts, segment, parts=['Tracks'])
-            
-            self.file_info['Tracks'] = info['Tracks']
+        info = yield defer_to_io_pool(read_segment_parts, filepath, ['Tracks'])
+        self.file_info['Tracks'] = info['Tracks']
         
         self.check_if_ready_to_stream()
     
@@ -283,116 +693,279 @@ class Encoder(object): # must always seperate subs / no room for custom fonts et
         
         return segment_id
     
-    def check_for_files_to_move(self, move_last=True):
-        files = sorted(os.listdir(self.temp_output_path))
+    def segment_completed(self, filename, job=None):
+        """
+        Called with each entry of ffmpeg's segment list, i.e. as soon as a segment is finished.
+        """
+        return self.move_segment(os.path.basename(filename), job)
+    
+    def move_segment(self, filename, job=None):
+        """
+        Moves a finished segment out of the temporary folder, returns a Deferred
+        firing with the segment id or None if nothing was moved.
+        """
+        return self.move_lock.run(self._move_segment, filename, job)
+    
+    @defer.inlineCallbacks
+    def _move_segment(self, filename, job):
+        segment_id = self._get_segment_id_from_filename(filename)
+        temp_output_path = job.temp_output_path if job else self.temp_output_path
+        filepath = os.path.join(temp_output_path, filename)
+        
+        if segment_id is None: # invalid filename, got no segment id, skipping
+            defer.returnValue(None)
+        
+        if job is not None and segment_id < job.start_segment_id: # this is a useless file
+            yield defer_to_io_pool(remove_file, filepath)
+            defer.returnValue(None)
+        
+        if segment_id in self.segment_removals: # the evicted copy must be gone before it is replaced
+            yield self.segment_removals[segment_id]
+        
+        result_file = os.path.join(self.output_path, filename)
+        size = yield defer_to_io_pool(store_segment, filepath, result_file)
+        if size is None: # already moved
+            defer.returnValue(None)
+        
+        self.segment_sizes[segment_id] = size
+        self.evicted_segments.discard(segment_id)
+        
+        if job is not None:
+            job.segment_moved(segment_id, self.get_segment_duration(segment_id))
+        
+        self.probe_tracks(result_file)
+        
+        if segment_id in self.segment_created_defers:
+            for d in self.segment_created_defers[segment_id]:
+                d.callback(None)
+            
+            del self.segment_created_defers[segment_id]
+        
+        defer.returnValue(segment_id)
+    
+    @defer.inlineCallbacks
+    def check_for_files_to_move(self, move_last=True, job=None):
+        if job is None:
+            for job in list(self.jobs):
+                yield self.check_for_files_to_move(move_last, job)
+            return
+        
+        files = yield defer_to_io_pool(list_folder, job.temp_output_path)
         
         for i, filename in enumerate(files, 1):
             segment_id = self._get_segment_id_from_filename(filename)
-            filepath = os.path.join(self.temp_output_path, filename)
             
             if segment_id is None: # invalid filename, got no segment id, skipping
                 continue 
             
-            if segment_id < self.start_segment_id: # this is a useless file, it needs to be deleted if it is not in use
+            if segment_id < job.start_segment_id: # this is a useless file, it needs to be deleted if it is not in use
                 if len(files) > 1:
-                    os.remove(filepath)
+                    yield defer_to_io_pool(remove_file, os.path.join(job.temp_output_path, filename))
                 continue
             
             if i == len(files): # this is the last file, we cannot move that
-                if not move_last or segment_id != self.end_segment_id: # enables the ability to move the last file
+                if not move_last or segment_id != job.end_segment_id: # enables the ability to move the last file
                     continue
             
-            result_file = os.path.join(self.output_path, filename)
-            os.rename(filepath, result_file)
-            
-            self.probe_tracks(result_file)
-            
-            if segment_id in self.segment_created_defers:
-                for d in self.segment_created_defers[segment_id]:
-                    d.callback(None)
-                
-                del self.segment_created_defers[segment_id]
+            yield self.move_segment(filename, job)
     
-    def clean_temp_output_folder(self):
-        for f in os.path.listdir(self.temp_output_path): # make sure the output folder is empty
-            os.remove(os.path.join(self.temp_output_path, f))
+    def clean_temp_output_folder(self, job):
+        return defer_to_io_pool(shutil.rmtree, job.temp_output_path, True)
     
     def start_encoding(self, start_segment_id, end_segment_id=None): # 'output-%05d.mkv'
-        self.start_segment_id = start_segment_id
-        self.end_segment_id = end_segment_id
+        if end_segment_id is None:
+            end_segment_id = len(self.cue_times)-1
+        
+        job = EncodeJob(self, start_segment_id, end_segment_id,
+                        os.path.join(self.temp_output_path, str(next(self.job_ids))))
         
-        if self.end_segment_id is None:
-            self.end_segment_id = len(self.cue_times)-1
+        start_time = Decimal(self.cue_times[start_segment_id])
+        segment_times = self.cue_times[start_segment_id+1:end_segment_id+1]
+        if self.segment_times_relative:
+            segment_times = [str(Decimal(cue_time) - start_time) for cue_time in segment_times]
         
-        self.move_timer.start(1.0)
+        # -ss is relative to the start time of the file, so aim between this cue and the next to land
+        # on the keyframe of this cue. The timestamps of the source are kept, so segments from different
+        # jobs line up and segment times are the cue times, unless this ffmpeg counts them from the first
+        # packet. Also done for the first segment, otherwise ffmpeg shifts the timestamps of files starting below zero.
+        seek_time = start_time + Decimal(str(min(self.get_segment_duration(start_segment_id), 1))) / 2
         
         cmd = [
-            self.ffmpeg_path, '-i', self.url, '-sn', '-codec', 'copy', '-map', '0',
+            self.ffmpeg_path, '-noaccurate_seek', '-ss', str(seek_time), '-copyts',
+            '-i', self.input_url, '-sn', '-codec', 'copy', '-map', '0',
             '-c:a', 'aac', '-strict', '-2', '-b:a', '384k',
             '-f', 'segment', '-segment_format', 'mkv',
-            '-segment_times', ','.join(self.cue_times[start_segment_id+1:]),
-        ]
+            '-segment_list', 'pipe:1', '-segment_list_type', 'flat',
+            '-segment_start_number', str(start_segment_id),
+        ] + PROGRESS_ARGS
         
-        if start_segment_id > 0:
-            initial_offset = self.cue_times[start_segment_id]
-            
-            cmd += [
-                '-segment_start_number', str(start_segment_id-1),
-                '-initial_offset', str(initial_offset),
-                '-ss', str(initial_offset),
-            ]
+        if segment_times:
+            cmd += ['-segment_times', ','.join(segment_times)]
         
-        if end_segment_id is not None:
+        if end_segment_id < len(self.cue_times)-1:
             cmd += [
-                '-to', self.cue_times[end_segment_id+1],
+                '-to', self.cue_times[end_segment_id+1], # timestamps are kept, so this is not relative to the seek
             ]
         
         cmd += [
-            os.path.join(self.temp_output_path, OUTPUT_FORMAT),
+            os.path.join(job.temp_output_path, OUTPUT_FORMAT),
         ]
         
-        self.ffmpeg_process = FFMpegPP()
-        
-        reactor.spawnProcess(self.ffmpeg_process, self.ffmpeg_path, cmd)
+        self.jobs.append(job)
+        job.start(cmd).addErrback(log.err, 'Failed to start encoding %s from segment %s' % (self.url, start_segment_id))
         
-        def done_encoding(ignored):
-            self.stop_encoding(successful=True)
+        return job
+    
+    def start_parallel_encoding(self):
+        """
+        Splits the segments into a range per worker and encodes them in parallel.
+        """
+        segment_count = len(self.cue_times)
+        workers = max(min(self.workers, segment_count), 1)
+        range_size = (segment_count + workers - 1) // workers
         
-        self.ffmpeg_process.finished.addCallback(done_encoding)
+        for start_segment_id in range(0, segment_count, range_size):
+            self.start_encoding(start_segment_id, min(start_segment_id + range_size, segment_count) - 1)
     
-    def stop_encoding(self, successful=False):
-        self.move_timer.stop()
+    @defer.inlineCallbacks
+    def stop_encoding(self, successful=False, job=None):
+        if job is None:
+            yield defer.gatherResults([self.stop_encoding(successful, job) for job in list(self.jobs)])
+            return
+        
+        if job not in self.jobs:
+            return
+        self.jobs.remove(job)
         
         if not successful:
-            self.ffmpeg_process.transport.signalProcess('KILL')
-            pass # kill process
+            job.kill()
         
-        self.check_for_files_to_move(move_last=successful)
+        yield self.check_for_files_to_move(successful, job)
+        yield self.clean_temp_output_folder(job) # anything left is incomplete
         
-        # kills the encoding, needed if we need to start from new segment
-        # stop move timer, run check_for_files_to_move, cleanup temp folder
-        pass
+        if successful: # continue with whatever is still missing
+            if not self._segment_exists(job.start_segment_id):
+                self.failed_segments.add(job.start_segment_id)
+            self.encode_next_missing()
     
     @defer.inlineCallbacks
     def extract_info(self):
-        httpfile = HttpFile(self.url)
-        doc = MatroskaDocument(httpfile)
-        segment = doc.roots[1]
-        self.file_info = yield threads.deferToThread(extract_parts, segment, parts=['Cues', 'Info'])
-        self.file_info['Size'] = segment.size
+        source_cache = None
+        if self.source_caches is not None and self.local_path is None:
+            source_cache = yield self.source_caches.get(self.url)
+        
+        self.file_info = yield defer_to_probe_pool(parse_source, self.url, ['Cues', 'Info'], source_cache)
+        if not self.file_info.get('Cues'):
+            raise NoUsefulInfoFoundException('No cue points found in %s' % (self.url, ))
         
         self.cue_times = [str(Decimal(k)/1000) for k in sorted(self.file_info['Cues'].keys())]
+        self.segment_times_relative = yield is_segment_times_relative(self.ffmpeg_path)
+    
+    def get_disk_usage(self):
+        return sum(self.segment_sizes.values())
+    
+    def get_eviction_candidates(self, keep_behind=0):
+        """
+        Segments on disk more than keep_behind segments behind every reader,
+        as a list of (last read, segment id, size). All segments are candidates
+        if there are no readers.
+        """
+        slowest_segment_id = None
+        if self.base_container:
+            slowest_index = self.base_container.get_slowest_reader_index()
+            if slowest_index is not None:
+                slowest_segment_id = slowest_index - 1 # first element is the header
+        
+        candidates = []
+        for segment_id, size in self.segment_sizes.items():
+            if slowest_segment_id is not None and segment_id >= slowest_segment_id - keep_behind:
+                continue
+            
+            candidates.append((self.segment_access.get(segment_id, 0), segment_id, size))
+        
+        return candidates
+    
+    def evict_segment(self, segment_id):
+        """
+        Removes a finished segment from disk, it is encoded again if someone reads it.
+        """
+        if segment_id not in self.segment_sizes:
+            return 0
+        
+        filepath = os.path.join(self.output_path, OUTPUT_FORMAT % segment_id)
+        d = defer.gatherResults([defer_to_io_pool(remove_file, path) for path in [filepath, filepath + INDEX_SUFFIX]], consumeErrors=True)
+        d.addErrback(log.err, 'Failed to remove evicted segment %s of %s' % (segment_id, self.url))
+        
+        def removed(ignored):
+            if self.segment_removals.get(segment_id) is d:
+                del self.segment_removals[segment_id]
+        
+        self.segment_removals[segment_id] = d
+        d.addCallback(removed)
+        
+        segment_cache.remove((self.output_path, segment_id))
+        self.segment_access.pop(segment_id, None)
+        self.evicted_segments.add(segment_id)
+        return self.segment_sizes.pop(segment_id)
+    
+    def get_stats(self):
+        container = self.base_container
+        return {
+            'encode_head': self.get_encode_head(),
+            'encode_speed': self.get_encode_speed(),
+            'encode_jobs': len(self.jobs),
+            'segments': len(self.cue_times) if self.cue_times is not None else None,
+            'segments_on_disk': len(self.segment_sizes),
+            'disk_usage': self.get_disk_usage(),
+            'waiting_segments': len(self.segment_created_defers),
+            'blocked_time': self.blocked_time,
+            'progress': [job.process.progress for job in self.jobs if job.process is not None],
+            'reader_positions': sorted(reader.tell() for reader in container.readers) if container else [],
+            'bytes_served': container.bytes_read if container else 0,
+        }
+    
+    def create_output_folders(self):
+        """
+        Creates the folders the encode is saved in, this blocks.
+        """
+        create_folder(self.output_path)
+        create_folder(self.temp_output_path)
+    
+    def close(self):
+        """
+        Stops all encoding and drops the segments and containers kept in memory.
+        Returns a Deferred that fires when the last segments have been moved into place.
+        """
+        self.closed = True
+        stopped = self.stop_encoding()
+        
+        for key in segment_cache.keys():
+            if key[0] == self.output_path:
+                segment_cache.remove(key)
+        
+        self.base_container = None
+        
+        waiting = self.container_defers + sum(self.segment_created_defers.values(), [])
+        self.container_defers = []
+        self.segment_created_defers = dict()
+        for d in waiting: # nothing is going to produce what they wait for
+            d.errback(defer.CancelledError('Encoding of %s was stopped' % (self.url, )))
+        
+        return stopped
     
     @defer.inlineCallbacks
     def prepare_encode(self):
         yield self.extract_info()
-        self.start_encoding(0) # need to continue when first element is moved
+        if self.closed:
+            return
+        self.start_parallel_encoding() # need to continue when first element is moved
     # encode
 
 if __name__ == '__main__':
     import sys
     
     encoder = Encoder(sys.argv[1], 'unpack/tmp/', './ffmpeg', './ffprobe')
+    encoder.create_output_folders()
     encoder.prepare_encode()
     
     @defer.inlineCallbacks
@@ -8,11 +8,19 @@ from twisted.web import http, resource, server, static
 # /NOTICE!
 
 class NoRangeStaticProducer(static.NoRangeStaticProducer):
+    reading = False
+
     @defer.inlineCallbacks
     def resumeProducing(self):
+        if not self.request or self.reading: # the read in progress will write and trigger a new resume
+            return
+        self.reading = True
+        try:
+            data = yield defer.maybeDeferred(self.fileObject.read, self.bufferSize)
+        finally:
+            self.reading = False
         if not self.request:
             return
-        data = yield defer.maybeDeferred(self.fileObject.read, self.bufferSize)
         if data:
             # this .write will spin the reactor, calling .doWrite and then
             # .resumeProducing again, so be prepared for a re-entrant call
@@ -23,12 +31,20 @@ class NoRangeStaticProducer(static.NoRangeStaticProducer):
             self.stopProducing()
 
 class SingleRangeStaticProducer(static.SingleRangeStaticProducer):
+    reading = False
+
     @defer.inlineCallbacks
     def resumeProducing(self):
+        if not self.request or self.reading:
+            return
+        self.reading = True
+        try:
+            data = yield defer.maybeDeferred(self.fileObject.read,
+                min(self.bufferSize, self.size - self.bytesWritten))
+        finally:
+            self.reading = False
         if not self.request:
             return
-        data = yield defer.maybeDeferred(self.fileObject.read,
-            min(self.bufferSize, self.size - self.bytesWritten))
         if data:
             self.bytesWritten += len(data)
             # this .write will spin the reactor, calling .doWrite and then
@@ -40,9 +56,11 @@ class SingleRangeStaticProducer(static.SingleRangeStaticProducer):
             self.stopProducing()
 
 class MultipleRangeStaticProducer(static.MultipleRangeStaticProducer):
+    reading = False
+
     @defer.inlineCallbacks
     def resumeProducing(self):
-        if not self.request:
+        if not self.request or self.reading:
             return
         data = []
         dataLength = 0
@@ -52,9 +70,15 @@ class MultipleRangeStaticProducer(static.MultipleRangeStaticProducer):
                 dataLength += len(self.partBoundary)
                 data.append(self.partBoundary)
                 self.partBoundary = None
-            p = yield defer.maybeDeferred(self.fileObject.read,
-                min(self.bufferSize - dataLength,
-                    self._partSize - self._partBytesWritten))
+            self.reading = True
+            try:
+                p = yield defer.maybeDeferred(self.fileObject.read,
+                    min(self.bufferSize - dataLength,
+                        self._partSize - self._partBytesWritten))
+            finally:
+                self.reading = False
+            if not self.request:
+                return
             self._partBytesWritten += len(p)
             dataLength += len(p)
             data.append(p)
@@ -1,48 +1,336 @@
+import httplib
 import os
-import urllib2
+import Queue
+import socket
+import threading
+import urlparse
+
+from twisted.python import log
+
+from .cache import LRUCache
 
 PART_SIZE = 1024*1024
+MAX_REDIRECTS = 5
+CHUNK_CACHE_SIZE = 64*1024*1024
+PREFETCH_WORKERS = 4
+
+class ConnectionPool(object):
+    """
+    Keeps persistent HTTP/1.1 connections around per origin host so
+    range requests against the same server can skip the handshake.
+    """
+    def __init__(self, max_per_host=4, timeout=30):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def _get_key(self, url):
+        parsed = urlparse.urlsplit(url)
+        scheme = parsed.scheme.lower()
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        return scheme, parsed.hostname, port
+
+    def _create_connection(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+
+        with self.lock:
+            self.created += 1
+
+        return cls(host, port, timeout=self.timeout)
+
+    def get_connection(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                self.reused += 1
+                return connections.pop(), True
+
+        return self._create_connection(key), False
+
+    def release_connection(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_per_host:
+                connections.append(connection)
+                return
+            self.discarded += 1
+
+        connection.close()
+
+    def _request(self, url, headers):
+        key = self._get_key(url)
+        parsed = urlparse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        connection, reused = self.get_connection(key)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+
+            # the server probably closed our idle connection, try again with a fresh one
+            connection = self._create_connection(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except:
+                connection.close()
+                raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release_connection(key, connection)
+
+        return response, data
+
+    def request(self, url, headers=None):
+        """
+        Does a GET request against url and follows redirects.
+        Returns the final response and its body.
+        """
+        headers = dict(headers or {})
+        for _ in range(MAX_REDIRECTS):
+            response, data = self._request(url, headers)
+
+            if response.status in (301, 302, 303, 307, 308):
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+
+            if response.status >= 400:
+                raise IOError('Got status %s from %s' % (response.status, url))
+
+            return response, data
+
+        raise IOError('Too many redirects from %s' % (url, ))
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'idle': sum(len(connections) for connections in self.idle.values()),
+            }
+
+class Prefetcher(object):
+    """
+    Fetches tokens in the background on a small pool of worker threads.
+    Adjacent tokens are fetched with a single range request.
+    """
+    def __init__(self, workers=PREFETCH_WORKERS):
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.threads = []
+
+        self.requests = 0
+        self.tokens = 0
+
+    def _start_workers(self):
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self._worker, name='HttpFile prefetcher')
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self):
+        while True:
+            httpfile, tokens = self.queue.get()
+            try:
+                httpfile.fetch_tokens(tokens)
+            except Exception:
+                log.err(None, 'Failed to prefetch %r from %s' % (tokens, httpfile.url))
+            finally:
+                self._finish(httpfile.url, tokens)
+
+    def _finish(self, url, tokens):
+        with self.lock:
+            for token in tokens:
+                self.inflight.pop((url, token)).set()
+
+    def prefetch(self, httpfile, tokens):
+        """
+        Queue tokens for fetching, tokens already being fetched are skipped.
+        """
+        runs = []
+        with self.lock:
+            self._start_workers()
+
+            for token in tokens:
+                key = (httpfile.url, token)
+                if key in self.inflight:
+                    continue
+
+                self.inflight[key] = threading.Event()
+                if runs and runs[-1][-1] == token - 1:
+                    runs[-1].append(token)
+                else:
+                    runs.append([token])
+
+            self.requests += len(runs)
+            self.tokens += sum(len(run) for run in runs)
+
+        for run in runs:
+            self.queue.put((httpfile, run))
+
+    def wait(self, url, token):
+        """
+        Wait for a token if it is being fetched, returns True if we waited.
+        """
+        with self.lock:
+            event = self.inflight.get((url, token))
+
+        if event is None:
+            return False
+
+        event.wait()
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'tokens': self.tokens,
+                'inflight': len(self.inflight),
+                'queued': self.queue.qsize(),
+            }
+
+connection_pool = ConnectionPool()
+chunk_cache = LRUCache(CHUNK_CACHE_SIZE) # shared by all HttpFiles, keyed by (url, token)
+prefetcher = Prefetcher()
 
 class HttpFile(object):
-    def __init__(self, url):
+    def __init__(self, url, pool=None, cache=None, readahead=0, source_cache=None):
         self.url = url
+        self.pool = pool or connection_pool
+        self.cache = cache if cache is not None else chunk_cache
+        self.readahead = readahead
+        self.source_cache = source_cache
         self.size = 0
         self.current_pos = 0
-        self.data = {}
-        self.populate_token(0)
+        self.last_token = None
 
-    def populate_token(self, token):
-        req = urllib2.Request(self.url)
+        if source_cache is not None and source_cache.size:
+            self.size = source_cache.size
 
+        self.get_token(0)
+
+    def _get_token_range(self, token):
         start = token*PART_SIZE
-        end = (token+1)*PART_SIZE
+        return start, min(start+PART_SIZE, self.size)
+
+    def get_token(self, token):
+        cached = self.cache.get((self.url, token))
+        if cached is None and prefetcher.wait(self.url, token):
+            cached = self.cache.get((self.url, token))
+
+        if cached is not None:
+            self.size, data = cached
+            return data
+
+        if self.source_cache is not None and self.size:
+            data = self.source_cache.read(*self._get_token_range(token))
+            if data is not None:
+                self.cache.set((self.url, token), (self.size, data), len(data))
+                return data
+
+        return self.populate_token(token)
+
+    def populate_token(self, token):
+        return self.fetch_tokens([token])[token]
+
+    def fetch_tokens(self, tokens):
+        """
+        Fetches a list of adjacent tokens with one range request.
+        """
+        start = tokens[0]*PART_SIZE
+        end = (tokens[-1]+1)*PART_SIZE
 
         if self.size:
             end = min(end, self.size)
 
         end -= 1
 
-        req.headers['Range'] = 'bytes=%s-%s' % (start, end)
-        r = urllib2.urlopen(req)
-        self.size = int(r.info().get('Content-Range').split('/')[1])
-        self.data[token] = r.read()
+        r, data = self.pool.request(self.url, {'Range': 'bytes=%s-%s' % (start, end)})
+        size = int(r.getheader('content-range').split('/')[1])
+        self.size = size
+
+        retval = {}
+        for i, token in enumerate(tokens):
+            token_data = data[i*PART_SIZE:(i+1)*PART_SIZE]
+            self.cache.set((self.url, token), (size, token_data), len(token_data))
+            retval[token] = token_data
+
+        if self.source_cache is not None:
+            self.source_cache.write(start, data, size)
+
+        return retval
 
     def token(self, point):
         return point / PART_SIZE
 
+    def prefetch(self, current_token):
+        tokens = []
+        for token in range(current_token+1, current_token+1+self.readahead):
+            if token*PART_SIZE >= self.size:
+                break
+
+            if (self.url, token) in self.cache:
+                continue
+
+            if self.source_cache is not None and self.source_cache.has_range(*self._get_token_range(token)):
+                continue
+
+            tokens.append(token)
+
+        if tokens:
+            prefetcher.prefetch(self, tokens)
+
     def read(self, size=2048):
-        token = self.token(self.current_pos)
-        start = self.current_pos % PART_SIZE
-        end = start + size
+        retval = []
+        while size > 0 and self.current_pos < self.size:
+            token = self.token(self.current_pos)
+            start = self.current_pos % PART_SIZE
 
-        if token not in self.data:
-            self.populate_token(token)
+            if self.readahead and token != self.last_token:
+                self.prefetch(token)
+            self.last_token = token
 
-        data = self.data[token][start:end]
+            data = self.get_token(token)[start:start+size]
+            if not data:
+                break
 
-        self.current_pos += size
+            retval.append(data)
+            self.current_pos += len(data)
+            size -= len(data)
 
-        return data
+        return ''.join(retval)
 
     def seek(self, offset, whence=os.SEEK_SET):
         if whence == os.SEEK_SET:
@@ -54,4 +342,3 @@ class HttpFile(object):
 
     def tell(self):
         return self.current_pos
-
@@ -0,0 +1,50 @@
+import mmap
+import os
+import urllib
+import urlparse
+
+def get_local_path(url):
+    """
+    Returns the path if url is a file:// url or a plain path, otherwise None.
+    """
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme == 'file':
+        return urllib.url2pathname(parsed.path)
+    elif not parsed.scheme or len(parsed.scheme) == 1: # no scheme or a windows drive letter
+        return url
+    return None
+
+class LocalFile(object):
+    """
+    Read-only mmap backed file, a drop-in for HttpFile when the source is local.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.current_pos = 0
+
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = ''
+
+    def read(self, size=2048):
+        data = self.data[self.current_pos:self.current_pos+size]
+        self.current_pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.current_pos = offset
+        elif whence == os.SEEK_CUR:
+            self.current_pos += offset
+        elif whence == os.SEEK_END:
+            self.current_pos = self.size + offset
+
+    def tell(self):
+        return self.current_pos
+
+    def close(self):
+        if self.size:
+            self.data.close()
@@ -1,22 +1,168 @@
+import os
+import re
+import shutil
+import time
 import urllib
 
 from twisted.web import resource, server, http, error, util
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task
+from twisted.python import log
 
+from .encoder import list_folder
+from .localfile import get_local_path
 from .stream import Stream
+from .threadpools import defer_to_io_pool
+
+REAP_INTERVAL = 30
+RETENTION_INTERVAL = 10
+STREAM_FOLDER_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+def get_path_size(path):
+    """
+    Bytes used by path and everything in it and when it was last modified, this blocks.
+    """
+    try:
+        stat = os.lstat(path)
+    except OSError: # removed while we looked
+        return 0, 0
+    
+    size, modified = stat.st_size, stat.st_mtime
+    if os.path.isdir(path):
+        for name in list_folder(path):
+            child_size, child_modified = get_path_size(os.path.join(path, name))
+            size += child_size
+            modified = max(modified, child_modified)
+    
+    return size, modified
+
+def get_folder_sizes(folder):
+    """
+    Size and last modification of everything in folder by name, this blocks.
+    """
+    return dict((name, get_path_size(os.path.join(folder, name))) for name in list_folder(folder))
 
 class MainResource(resource.Resource):
     isLeaf = False
-    streams = {}
-    urlmap = {}
 
-    def __init__(self, output_folder, ffmpeg_path, ffprobe_path):
+    def __init__(self, output_folder, ffmpeg_path, ffprobe_path, source_caches=None, allow_local_files=False,
+                 idle_timeout=0, delete_idle_streams=False, disk_quota=0, retention_segments=0, seekable=False, encode_workers=1):
         self.output_folder = output_folder
         self.ffmpeg_path = ffmpeg_path
         self.ffprobe_path = ffprobe_path
+        self.source_caches = source_caches
+        self.allow_local_files = allow_local_files
+        self.idle_timeout = idle_timeout
+        self.delete_idle_streams = delete_idle_streams
+        self.disk_quota = disk_quota
+        self.retention_segments = retention_segments
+        self.seekable = seekable # remux sources with cue points so readers can seek, others are always streamed
+        self.encode_workers = encode_workers # ffmpeg processes per remuxed stream, streamed sources use one
+        
+        self.streams = {}
+        self.urlmap = {}
+        self.reaped_streams = 0
+        self.evicted_segments = 0
+        self.evicted_bytes = 0
+        self.removed_folders = 0
+        self.disk_usage = None # everything in output_folder, measured by enforce_retention
+        self.over_quota = False
+        
+        if idle_timeout:
+            self.reaper = task.LoopingCall(self.reap_idle_streams)
+            self.reaper.start(min(REAP_INTERVAL, idle_timeout), now=False)
+        
+        if disk_quota or retention_segments:
+            self.retention = task.LoopingCall(self.enforce_retention)
+            self.retention.start(RETENTION_INTERVAL, now=False)
         
         resource.Resource.__init__(self)
     
+    def reap_idle_streams(self):
+        """
+        Closes streams nobody has read from for idle_timeout seconds.
+        """
+        now = time.time()
+        for identifier, stream in self.streams.items():
+            if stream.readers or now - stream.last_active < self.idle_timeout:
+                continue
+            
+            log.msg('Stream %s has been idle since %s, closing it' % (identifier, stream.last_active))
+            del self.streams[identifier]
+            del self.urlmap[stream.url]
+            stream.close(self.delete_idle_streams)
+            self.reaped_streams += 1
+    
+    def get_disk_usage(self):
+        return sum(stream.encoder.get_disk_usage() for stream in self.streams.values())
+    
+    def _evict(self, stream, segment_id):
+        size = stream.encoder.evict_segment(segment_id)
+        self.evicted_segments += 1
+        self.evicted_bytes += size
+        return size
+    
+    @defer.inlineCallbacks
+    def enforce_retention(self):
+        """
+        Removes segments far behind every reader of their stream. If the output folder
+        is above the disk quota, folders left behind by closed streams are removed,
+        oldest first, then the least recently read segments not ahead of any reader.
+        """
+        if self.retention_segments:
+            for stream in self.streams.values():
+                if not stream.readers:
+                    continue
+                
+                for last_read, segment_id, size in stream.encoder.get_eviction_candidates(self.retention_segments):
+                    self._evict(stream, segment_id)
+        
+        if not self.disk_quota:
+            return
+        
+        folder_sizes = yield defer_to_io_pool(get_folder_sizes, self.output_folder)
+        disk_usage = self.disk_usage = sum(size for size, modified in folder_sizes.values())
+        if disk_usage <= self.disk_quota:
+            self.over_quota = False
+            return
+        
+        stale_folders = sorted((modified, name, size) for name, (size, modified) in folder_sizes.items()
+                               if name not in self.streams and STREAM_FOLDER_PATTERN.match(name))
+        for modified, name, size in stale_folders:
+            if disk_usage <= self.disk_quota:
+                break
+            log.msg('Removing %s left behind by a closed stream to get within the disk quota' % (name, ))
+            yield defer_to_io_pool(shutil.rmtree, os.path.join(self.output_folder, name), True)
+            disk_usage -= size
+            self.removed_folders += 1
+        
+        candidates = []
+        for stream in self.streams.values():
+            for last_read, segment_id, size in stream.encoder.get_eviction_candidates():
+                candidates.append((last_read, segment_id, stream))
+        candidates.sort(key=lambda candidate: candidate[:2])
+        
+        for last_read, segment_id, stream in candidates:
+            if disk_usage <= self.disk_quota:
+                break
+            disk_usage -= self._evict(stream, segment_id)
+        
+        self.disk_usage = disk_usage
+        if disk_usage > self.disk_quota and not self.over_quota: # streamed sources cannot be evicted, no need to repeat it until they are gone
+            log.msg('Disk usage is %s bytes, above the quota of %s bytes, with nothing left to evict' % (disk_usage, self.disk_quota))
+        self.over_quota = disk_usage > self.disk_quota
+    
+    def get_stats(self):
+        return {
+            'live_streams': len(self.streams),
+            'reaped_streams': self.reaped_streams,
+            'disk_usage': self.disk_usage if self.disk_usage is not None else self.get_disk_usage(),
+            'disk_quota': self.disk_quota,
+            'over_quota': self.over_quota,
+            'evicted_segments': self.evicted_segments,
+            'evicted_bytes': self.evicted_bytes,
+            'removed_folders': self.removed_folders,
+        }
+    
     def getChild(self, path, request):
         path = path.strip('/')
         if path in self.streams:
@@ -30,9 +176,12 @@ class MainResource(resource.Resource):
         if 'url' not in request.args:
             raise error.Error(http.BAD_REQUEST, 'Missing argument: url')
         url = request.args['url'][0]
+        
+        if not self.allow_local_files and get_local_path(url) is not None:
+            raise error.Error(http.FORBIDDEN, 'Local files are not allowed')
 
         if url not in self.urlmap:
-            stream = Stream(url, True, self.output_folder, self.ffmpeg_path, self.ffprobe_path) # we will just always use streaming encode for now
+            stream = Stream(url, not self.seekable, self.output_folder, self.ffmpeg_path, self.ffprobe_path, self.source_caches, self.encode_workers)
             identifier = stream.identifier
             self.streams[identifier] = stream
             self.urlmap[url] = identifier
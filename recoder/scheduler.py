@@ -0,0 +1,126 @@
+import itertools
+import time
+
+from twisted.internet import defer, reactor
+
+MAX_PROCESSES = 4
+
+class ProcessScheduler(object):
+    """
+    Process-wide queue in front of reactor.spawnProcess that limits the number
+    of ffmpeg processes running at once. Queued processes are started in order
+    of demand, i.e. the number of readers blocked on them, when a slot frees up.
+    Stopped processes give up their slot and queue for one again to continue.
+    """
+    def __init__(self, max_processes=MAX_PROCESSES):
+        self.max_processes = max_processes
+        self.running = set()
+        self.paused = set()
+        self.queue = [] # list of (sequence, process protocol, args or None to resume, priority function, deferred, time queued, spawnProcess kwargs)
+        self.sequence = itertools.count()
+
+        self.spawned = 0
+        self.resumed = 0
+        self.cancelled = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+
+    def spawn(self, process_protocol, args, priority=None, **kwargs):
+        """
+        Spawns process_protocol with args when there is room for it.
+        priority is a function returning the current demand for the process,
+        it is called every time a slot frees up. kwargs are passed on to spawnProcess.
+
+        Returns a Deferred that fires when the process is started.
+        """
+        d = defer.Deferred()
+        self.queue.append((next(self.sequence), process_protocol, args, priority, d, time.time(), kwargs))
+        self._start_next()
+        return d
+
+    def pause(self, process_protocol):
+        """
+        Frees the slot of a process that has been stopped.
+        """
+        if process_protocol in self.running:
+            self.running.remove(process_protocol)
+            self.paused.add(process_protocol)
+            self._start_next()
+
+    def resume(self, process_protocol, priority=None):
+        """
+        Queues a paused process for a slot again.
+
+        Returns a Deferred that fires when it has a slot and can be continued.
+        """
+        d = defer.Deferred()
+        self.queue.append((next(self.sequence), process_protocol, None, priority, d, time.time(), {}))
+        self._start_next()
+        return d
+
+    def cancel(self, process_protocol):
+        """
+        Removes a process that is still queued to start or resume, returns True if it was found.
+        """
+        for i, item in enumerate(self.queue):
+            if item[1] is process_protocol:
+                del self.queue[i]
+                self.cancelled += 1
+                return True
+        return False
+
+    def set_max_processes(self, max_processes):
+        self.max_processes = max_processes
+        self._start_next()
+
+    def _get_priority(self, item):
+        sequence, priority = item[0], item[3]
+        demand = priority() if priority is not None else 0
+        return (-demand, sequence)
+
+    def _start_next(self):
+        while self.queue and len(self.running) < self.max_processes:
+            item = min(self.queue, key=self._get_priority)
+            self.queue.remove(item)
+
+            sequence, process_protocol, args, priority, d, queued, kwargs = item
+            wait_time = time.time() - queued
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+            self.running.add(process_protocol)
+            if args is None:
+                self.paused.discard(process_protocol)
+                self.resumed += 1
+            else:
+                self.spawned += 1
+                process_protocol.finished.addBoth(self._process_finished, process_protocol)
+                reactor.spawnProcess(process_protocol, args[0], args, **kwargs)
+
+            d.callback(wait_time)
+
+    def _process_finished(self, result, process_protocol):
+        self.running.discard(process_protocol)
+        self.paused.discard(process_protocol)
+        self.queue = [item for item in self.queue if item[1] is not process_protocol] # a resume that can never happen
+        reactor.callLater(0, self._start_next)
+        return result
+
+    def get_stats(self):
+        speeds = [process_protocol.progress['speed'] for process_protocol in self.running
+                  if getattr(process_protocol, 'progress', {}).get('speed') is not None]
+        return {
+            'running': len(self.running),
+            'paused': len(self.paused),
+            'behind_realtime': len([speed for speed in speeds if speed < 1]),
+            'queued': len(self.queue),
+            'max_processes': self.max_processes,
+            'spawned': self.spawned,
+            'resumed': self.resumed,
+            'cancelled': self.cancelled,
+            'total_wait_time': self.total_wait_time,
+            'max_wait_time': self.max_wait_time,
+            'avg_wait_time': self.total_wait_time / (self.spawned + self.resumed) if self.spawned + self.resumed else 0,
+        }
+
+scheduler = ProcessScheduler()
@@ -0,0 +1,353 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from twisted.application import service
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+from twisted.web import resource, server
+
+from .cache import LRUCache
+from .filelike import FilelikeObjectResource
+from .httpfile import PART_SIZE, HttpFile
+from .threadpools import defer_to_source_pool
+
+PROXY_READAHEAD = 4 # number of chunks to fetch ahead of ffmpeg
+MAX_OPEN_CACHES = 32 # source caches kept open, the least recently used are closed
+SOURCE_CACHE_SIZE = 10*1024*1024*1024 # bytes of sources kept on disk, the least recently used are removed
+MAINTENANCE_INTERVAL = 10 # seconds between saving metadata and enforcing the size limit
+
+class SourceCache(object):
+    """
+    A sparse local copy of a remote file.
+    Keeps track of what byte ranges are present in a metadata file next to the data.
+    """
+    def __init__(self, path, url):
+        self.url = url
+        self.data_path = path + '.data'
+        self.meta_path = path + '.json'
+        self.size = 0
+        self.ranges = [] # sorted list of non-overlapping [start, end) pairs
+        self.lock = threading.Lock()
+        self.meta_lock = threading.Lock()
+        self.dirty = False # ranges have been added since the metadata was saved
+        self.closed = False
+        self.last_used = time.time()
+
+        if os.path.isfile(self.meta_path) and os.path.isfile(self.data_path):
+            with open(self.meta_path, 'rb') as f:
+                meta = json.load(f)
+            self.size = meta['size']
+            self.ranges = meta['ranges']
+            self.f = open(self.data_path, 'r+b')
+        else:
+            self.f = open(self.data_path, 'w+b')
+
+    def save_meta(self):
+        """
+        Writes the metadata if it changed, the data it describes is already flushed. This blocks.
+        """
+        with self.meta_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                meta = {'url': self.url, 'size': self.size, 'ranges': list(self.ranges)}
+                self.dirty = False
+
+            tmp_path = self.meta_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                json.dump(meta, f)
+            os.rename(tmp_path, self.meta_path)
+
+    def _add_range(self, start, end):
+        ranges = []
+        for s, e in self.ranges:
+            if e < start or s > end:
+                ranges.append([s, e])
+            else:
+                start = min(s, start)
+                end = max(e, end)
+
+        ranges.append([start, end])
+        ranges.sort()
+        self.ranges = ranges
+
+    def has_range(self, start, end):
+        with self.lock:
+            if self.closed:
+                return False
+            for s, e in self.ranges:
+                if s <= start and end <= e:
+                    return True
+        return False
+
+    def read(self, start, end):
+        """
+        Returns the data between start and end if it is all present, otherwise None.
+        """
+        if not self.has_range(start, end):
+            return None
+
+        with self.lock:
+            if self.closed:
+                return None
+            self.last_used = time.time()
+            self.f.seek(start)
+            return self.f.read(end-start)
+
+    def write(self, start, data, size):
+        with self.lock:
+            if self.closed: # readers that were open when it got closed fetch from the origin only
+                return
+            self.f.seek(start)
+            self.f.write(data)
+            self.f.flush()
+
+            self.size = size
+            self.last_used = time.time()
+            self._add_range(start, start+len(data))
+            self.dirty = True
+
+    def close(self):
+        self.save_meta()
+        with self.lock:
+            self.closed = True
+            self.f.close()
+
+    def get_cached_size(self):
+        with self.lock:
+            return sum(e-s for s, e in self.ranges)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'cached': sum(e-s for s, e in self.ranges),
+            }
+
+def get_cached_sizes(folder):
+    """
+    The cached bytes and last modification of every source in folder, keyed by cache key. This blocks.
+    """
+    sizes = {}
+    for filename in os.listdir(folder):
+        if not filename.endswith('.json'):
+            continue
+
+        path = os.path.join(folder, filename)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.load(f)
+            sizes[filename[:-len('.json')]] = [os.path.getmtime(path), sum(e-s for s, e in meta['ranges'])]
+        except (IOError, OSError, ValueError, KeyError):
+            continue
+
+    return sizes
+
+def remove_source(path):
+    for suffix in ('.data', '.json'):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+class SourceReader(object):
+    """
+    File-like object reading a source through its local cache.
+    """
+    def __init__(self, httpfile):
+        self.httpfile = httpfile
+
+    def read(self, size=4096):
+        return defer_to_source_pool(self.httpfile.read, size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.httpfile.seek(offset, whence)
+
+    def tell(self):
+        return self.httpfile.tell()
+
+    def close(self):
+        pass
+
+class SourceResource(FilelikeObjectResource):
+    encoding = None
+
+class SourceProxyResource(resource.Resource):
+    """
+    Serves cached sources over HTTP with range support so ffmpeg and ffprobe can read through the cache.
+    """
+    isLeaf = True
+
+    def __init__(self, source_caches):
+        self.source_caches = source_caches
+        resource.Resource.__init__(self)
+
+    def render_GET(self, request):
+        key = request.postpath[0] if request.postpath else ''
+        d = self.source_caches.get_by_key(key)
+        if d is None:
+            return resource.NoResource().render(request)
+
+        def create_reader(source_cache):
+            cache = LRUCache(PART_SIZE * (PROXY_READAHEAD + 2)) # keep the shared chunk cache free of sequential reads
+            return HttpFile(source_cache.url, cache=cache, readahead=PROXY_READAHEAD, source_cache=source_cache)
+
+        def got_httpfile(httpfile):
+            retval = SourceResource(SourceReader(httpfile), httpfile.size).render(request)
+            if retval is not server.NOT_DONE_YET: # HEAD only gets the headers
+                request.write(retval)
+                request.finish()
+
+        def failed(reason):
+            log.err(reason, 'Failed to open source %s' % (self.source_caches.urls[key], ))
+            request.setResponseCode(502)
+            request.finish()
+
+        d.addCallback(lambda source_cache: defer_to_source_pool(create_reader, source_cache))
+        d.addCallbacks(got_httpfile, failed)
+        return server.NOT_DONE_YET
+    render_HEAD = render_GET
+
+class SourceCacheManager(service.Service):
+    """
+    Keeps the source caches for all urls in a folder and serves them on a local port.
+    Only the most recently used caches are kept open and the least recently used
+    sources are removed from disk when the folder grows beyond max_size.
+    """
+    port = None
+
+    def __init__(self, folder, max_size=SOURCE_CACHE_SIZE, max_open=MAX_OPEN_CACHES):
+        self.folder = folder
+        self.max_size = max_size
+        self.max_open = max_open
+        self.caches = OrderedDict() # open caches, least recently used first
+        self.opening = {} # key -> Deferreds waiting for a cache being opened
+        self.urls = {} # key -> url of every source handed out
+        self.cached_sizes = {} # key -> [last used, cached bytes] of every source on disk
+        self.removed_sources = 0
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def get_key(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def get(self, url):
+        """
+        Returns a Deferred with the source cache of url, it is opened if needed.
+        """
+        key = self.get_key(url)
+        self.urls[key] = url
+        if key in self.caches:
+            self.caches[key] = self.caches.pop(key)
+            return defer.succeed(self.caches[key])
+
+        d = defer.Deferred()
+        if key in self.opening:
+            self.opening[key].append(d)
+            return d
+        self.opening[key] = [d]
+
+        def opened(source_cache):
+            self.caches[key] = source_cache
+            self.close_unused()
+            for waiting in self.opening.pop(key):
+                waiting.callback(source_cache)
+
+        def failed(reason):
+            for waiting in self.opening.pop(key):
+                waiting.errback(reason)
+
+        defer_to_source_pool(SourceCache, os.path.join(self.folder, key), url).addCallbacks(opened, failed)
+        return d
+
+    def close_unused(self):
+        while len(self.caches) > self.max_open:
+            key, source_cache = self.caches.popitem(last=False)
+            self._close(key, source_cache)
+
+    def _close(self, key, source_cache):
+        self.cached_sizes[key] = [source_cache.last_used, source_cache.get_cached_size()]
+        d = defer_to_source_pool(source_cache.close)
+        d.addErrback(log.err, 'Failed to close source cache %s' % (source_cache.url, ))
+        return d
+
+    def save_meta(self):
+        for source_cache in self.caches.values():
+            if source_cache.dirty:
+                d = defer_to_source_pool(source_cache.save_meta)
+                d.addErrback(log.err, 'Failed to save source cache metadata of %s' % (source_cache.url, ))
+
+    def get_disk_usage(self):
+        for key, source_cache in self.caches.items():
+            self.cached_sizes[key] = [source_cache.last_used, source_cache.get_cached_size()]
+        return sum(size for last_used, size in self.cached_sizes.values())
+
+    def remove_unused(self):
+        """
+        Removes the least recently used sources from disk until we are within max_size.
+        """
+        if not self.max_size:
+            return
+
+        disk_usage = self.get_disk_usage()
+        for last_used, key in sorted((last_used, key) for key, (last_used, size) in self.cached_sizes.items()):
+            if disk_usage <= self.max_size:
+                break
+
+            d = defer.succeed(None)
+            if key in self.caches:
+                d = self._close(key, self.caches.pop(key))
+
+            disk_usage -= self.cached_sizes.pop(key)[1]
+            self.removed_sources += 1
+            d.addCallback(lambda ignored, key=key: defer_to_source_pool(remove_source, os.path.join(self.folder, key)))
+            d.addErrback(log.err, 'Failed to remove cached source %s' % (key, ))
+
+    def maintain(self):
+        self.save_meta()
+        self.remove_unused()
+
+    def get_by_key(self, key):
+        if key not in self.urls:
+            return None
+        return self.get(self.urls[key])
+
+    def get_proxy_url(self, url):
+        self.urls[self.get_key(url)] = url # opened when the proxy is asked for it
+        return 'http://127.0.0.1:%d/%s' % (self.port.getHost().port, self.get_key(url))
+
+    def get_stats(self):
+        return {
+            'open': len(self.caches),
+            'disk_usage': self.get_disk_usage(),
+            'max_size': self.max_size,
+            'removed_sources': self.removed_sources,
+        }
+
+    @defer.inlineCallbacks
+    def load_cached_sizes(self):
+        cached_sizes = yield defer_to_source_pool(get_cached_sizes, self.folder)
+        cached_sizes.update(self.cached_sizes) # anything opened meanwhile is more up to date
+        self.cached_sizes = cached_sizes
+
+    def startService(self):
+        service.Service.startService(self)
+        self.port = reactor.listenTCP(0, server.Site(SourceProxyResource(self)), interface='127.0.0.1')
+
+        self.load_cached_sizes().addErrback(log.err, 'Failed to read the size of the source cache')
+        self.maintenance = task.LoopingCall(self.maintain)
+        self.maintenance.start(MAINTENANCE_INTERVAL, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.maintenance.running:
+            self.maintenance.stop()
+        for source_cache in self.caches.values():
+            source_cache.close()
+        return self.port.stopListening()
@@ -0,0 +1,101 @@
+import json
+import numbers
+
+from twisted.web import resource
+
+from . import threadpools
+from .encoder import segment_cache
+from .httpfile import chunk_cache, connection_pool, prefetcher
+from .scheduler import scheduler
+
+def get_hit_rate(stats):
+    requests = stats['hits'] + stats['misses']
+    return float(stats['hits']) / requests if requests else 0
+
+def get_stats(main_resource):
+    """
+    Everything we know about the running service as a dict.
+    """
+    segment_cache_stats = segment_cache.get_stats()
+    segment_cache_stats['hit_rate'] = get_hit_rate(segment_cache_stats)
+
+    chunk_cache_stats = chunk_cache.get_stats()
+    chunk_cache_stats['hit_rate'] = get_hit_rate(chunk_cache_stats)
+
+    stats = {
+        'service': main_resource.get_stats(),
+        'ffmpeg': scheduler.get_stats(),
+        'segment_cache': segment_cache_stats,
+        'chunk_cache': chunk_cache_stats,
+        'connection_pool': connection_pool.get_stats(),
+        'prefetcher': prefetcher.get_stats(),
+        'threadpools': threadpools.get_stats(),
+        'streams': dict((identifier, stream.get_stats()) for identifier, stream in main_resource.streams.items()),
+    }
+
+    if main_resource.source_caches is not None:
+        stats['source_cache'] = main_resource.source_caches.get_stats()
+
+    return stats
+
+def flatten(value, name, labels, metrics):
+    """
+    Turns nested dicts and lists of numbers into (name, labels, value) for Prometheus.
+    """
+    if isinstance(value, bool):
+        metrics.append((name, labels, int(value)))
+    elif isinstance(value, numbers.Number):
+        metrics.append((name, labels, value))
+    elif isinstance(value, dict):
+        for key, v in sorted(value.items()):
+            flatten(v, '%s_%s' % (name, key), labels, metrics)
+    elif isinstance(value, (list, tuple)):
+        metrics.append(('%s_count' % (name, ), labels, len(value)))
+        for i, v in enumerate(value):
+            flatten(v, name, labels + [('index', str(i))], metrics)
+
+def format_prometheus(stats):
+    metrics = []
+    for key, value in sorted(stats.items()):
+        if key == 'streams':
+            continue
+        if key == 'threadpools':
+            for pool_name, pool_stats in sorted(value.items()):
+                tasks = pool_stats.pop('tasks')
+                flatten(pool_stats, 'recoder_threadpool', [('pool', pool_name)], metrics)
+                for task_name, task_stats in sorted(tasks.items()):
+                    flatten(task_stats, 'recoder_threadpool_task', [('pool', pool_name), ('task', task_name)], metrics)
+            continue
+        flatten(value, 'recoder_%s' % (key, ), [], metrics)
+
+    for identifier, stream_stats in sorted(stats['streams'].items()):
+        flatten(stream_stats, 'recoder_stream', [('stream', identifier)], metrics)
+
+    lines = []
+    metrics.sort(key=lambda metric: metric[0]) # samples of a metric must be next to each other
+    for name, labels, value in metrics:
+        if labels:
+            name += '{%s}' % (','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels), )
+        lines.append('%s %s' % (name, value))
+
+    return '\n'.join(lines) + '\n'
+
+class StatsResource(resource.Resource):
+    """
+    Serves the stats as JSON, or in the Prometheus text format with ?format=prometheus.
+    """
+    isLeaf = True
+
+    def __init__(self, main_resource):
+        self.main_resource = main_resource
+        resource.Resource.__init__(self)
+
+    def render_GET(self, request):
+        stats = get_stats(self.main_resource)
+
+        if request.args.get('format', [None])[0] == 'prometheus':
+            request.setHeader('content-type', 'text/plain; version=0.0.4')
+            return format_prometheus(stats)
+
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(stats, indent=2)
@@ -1,36 +1,114 @@
 import os
+import shutil
+import time
 import uuid
 
+from twisted.internet import defer
+from twisted.python import log
 from twisted.web import resource, server
 
 from .encoder import Encoder
 from .streamingencoder import StreamingEncoder
 from .encoder import Encoder
 from .filelike import FilelikeObjectResource
+from .threadpools import defer_to_io_pool
 
 class Stream(resource.Resource):
     isLeaf = True
     
-    def __init__(self, url, streaming_encode, output_folder, ffmpeg_path, ffprobe_path):
+    def __init__(self, url, streaming_encode, output_folder, ffmpeg_path, ffprobe_path, source_caches=None, workers=None):
         self.identifier = str(uuid.uuid4())
         self.url = url
+        self.readers = 0
+        self.last_active = time.time()
+        self.ffmpeg_path = ffmpeg_path
+        self.ffprobe_path = ffprobe_path
+        self.source_caches = source_caches
+        self.workers = workers
         
         output_folder = os.path.join(output_folder, self.identifier)
-        os.mkdir(output_folder)
+        self.output_folder = output_folder
        
         if streaming_encode:
             cls = StreamingEncoder
         else:
             cls = Encoder
         
-        self.encoder = cls(url, output_folder, ffmpeg_path, ffprobe_path)
-        self.encoder.prepare_encode()
+        self.start_encoder(cls)
         
         resource.Resource.__init__(self)
     
+    def start_encoder(self, cls):
+        encoder = self.encoder = cls(self.url, self.output_folder, self.ffmpeg_path, self.ffprobe_path, self.source_caches, self.workers)
+        
+        d = defer_to_io_pool(encoder.create_output_folders)
+        d.addCallback(lambda ignored: encoder.prepare_encode())
+        d.addErrback(self.encoder_failed, encoder)
+    
+    def encoder_failed(self, reason, encoder):
+        """
+        Sources Encoder cannot find the cue points of, or cannot parse at all, are streamed instead.
+        """
+        if isinstance(encoder, StreamingEncoder) or encoder.closed:
+            log.err(reason, 'Failed to start encoding %s' % (self.url, ))
+            return
+        
+        log.err(reason, 'Cannot remux %s with its cue points, streaming it instead' % (self.url, ))
+        container_defers = encoder.container_defers
+        encoder.container_defers = [] # handed over, not cancelled
+        encoder.close()
+        
+        self.start_encoder(StreamingEncoder)
+        self.encoder.container_defers.extend(container_defers)
+    
+    def close(self, delete_files=False):
+        """
+        Stops the encode and releases everything kept around for this stream.
+        The files are deleted after the encoder is done moving segments into place.
+        """
+        d = self.encoder.close()
+        d.addErrback(log.err, 'Failed to stop encoding %s' % (self.url, ))
+        
+        if delete_files:
+            d.addCallback(lambda ignored: defer_to_io_pool(shutil.rmtree, self.output_folder, True))
+        
+        return d
+    
+    def get_stats(self):
+        stats = self.encoder.get_stats()
+        stats['url'] = self.url
+        stats['requests'] = self.readers
+        stats['idle_time'] = time.time() - self.last_active if not self.readers else 0
+        return stats
+    
     def render_GET(self, request):
+        self.readers += 1
+        self.last_active = time.time()
+        
+        finished = []
+        containers = []
+        
+        def request_finished(ignored):
+            finished.append(True)
+            self.readers -= 1
+            self.last_active = time.time()
+            for container in containers:
+                container.close() # the reader is gone, let the encoder know
+        request.notifyFinish().addBoth(request_finished) # never fires if registered after the request is gone
+        
         def got_container(container):
+            if finished: # the reader left while we waited for the container
+                container.close()
+                return
+            
+            containers.append(container)
             FilelikeObjectResource(container, container.get_size()).render(request)
         
-        self.encoder.get_container().addCallback(got_container)
+        def failed(reason):
+            reason.trap(defer.CancelledError)
+            if not finished: # the stream was closed before it got going
+                request.setResponseCode(503)
+                request.finish()
+        
+        self.encoder.get_container().addCallbacks(got_container, failed)
         return server.NOT_DONE_YET
\ No newline at end of file
@@ -1,23 +1,34 @@
 import json
 import os
+import signal
+import time
 
 from collections import defaultdict
 from decimal import Decimal
 from functools import partial
-from StringIO import StringIO
 
 from ebml.schema.matroska import MatroskaDocument
 
-from twisted.internet import defer, protocol, reactor, task, threads, utils
+from twisted.internet import defer, error, protocol, reactor, task, threads, utils
 
-from .container import FileContainer
+from .container import FileContainer, LazyElement, StringElement
 from .ebmltools import create_cues_element, create_ebml_header, create_info_element, create_seek_element, create_segment_header_element, create_void, extract_parts
-from .encoder import FFMpegPP, wrap_segment, LazyStringIO, Encoder
+from .encoder import FFMpegPP, PROGRESS_ARGS, PROGRESS_FDS, read_segment_parts, wrap_segment, Encoder
 from .httpfile import HttpFile
+from .scheduler import scheduler
+from .threadpools import defer_to_io_pool
 
 OUTPUT_FORMAT = 'output-%05d.mkv'
+SEGMENT_TIME = 10 # seconds of media in each segment
 
 class StreamingEncoder(Encoder):
+    encoding_finished = False
+    encode_started = None
+    paused = False
+    resuming = False # waiting for the scheduler to give a paused ffmpeg a slot again
+    pause_segments_ahead = 10 # pause ffmpeg when it is this many segments ahead of the furthest reader, 0 to never pause
+    pause_without_readers = False # only safe when streams nobody reads are closed after a while
+    
     def _create_segment_header(self):
         timecodescale, duration = None, None
         
@@ -36,10 +47,6 @@ class StreamingEncoder(Encoder):
         
         return retval
     
-    def _get_segment_size(self, segment_id):
-        filepath = os.path.join(self.output_path, OUTPUT_FORMAT % segment_id)
-        return os.path.getsize(filepath)
-    
     def build_container(self):
         if self.base_container:
             return
@@ -49,96 +56,174 @@ class StreamingEncoder(Encoder):
         cluster_start = ebml_header_element + segment_header_element
         
         container = FileContainer()
-        container.write_element(StringIO(cluster_start), len(cluster_start))
+        container.write_element(StringElement(cluster_start), len(cluster_start))
         
-        for filename in os.listdir(self.output_path):
-            if not filename.startswith('output'):
-                continue
-            
-            segment_id = self._get_segment_id_from_filename(filename)
-            size = self._get_segment_size(segment_id)
-            container.write_element(LazyStringIO(partial(self.get_segment, segment_id, size), size), size)
+        for segment_id, size in sorted(self.segment_sizes.items()):
+            container.write_element(LazyElement(partial(self.get_segment, segment_id, size), size), size)
+        
+        if self.encoding_finished:
+            container.finish()
         
+        container.reader_moved = self.check_if_should_pause
         self.base_container = container
-        for d in self.container_defers:
+        container_defers, self.container_defers = self.container_defers, []
+        for d in container_defers:
             d.callback(self.base_container.copy())
     
+    @defer.inlineCallbacks
+    def _move_segment(self, filename, job):
+        segment_id = yield Encoder._move_segment(self, filename, job)
+        
+        if segment_id is not None and self.base_container:
+            size = self.segment_sizes[segment_id]
+            self.base_container.write_element(LazyElement(partial(self.get_segment, segment_id, size), size), size)
+            self.check_if_should_pause()
+        
+        defer.returnValue(segment_id)
+    
+    def get_encode_head(self):
+        return max(self.segment_sizes.keys() or [-1])
+    
+    def get_encode_speed(self):
+        if self.ffmpeg_process is not None and self.ffmpeg_process.progress.get('speed'):
+            return self.ffmpeg_process.progress['speed']
+        
+        if self.encode_started is None or not self.segment_sizes:
+            return None
+        
+        return len(self.segment_sizes) * SEGMENT_TIME / max(time.time() - self.encode_started, 0.001)
+    
+    def get_stats(self):
+        stats = Encoder.get_stats(self)
+        stats['encode_jobs'] = int(self.ffmpeg_process is not None)
+        stats['progress'] = [self.ffmpeg_process.progress] if self.ffmpeg_process is not None else []
+        stats['paused'] = self.paused
+        stats['encoding_finished'] = self.encoding_finished
+        return stats
+    
+    def get_eviction_candidates(self, keep_behind=0):
+        return [] # the encode cannot be restarted at a segment, so everything must stay on disk
+    
+    def check_if_should_pause(self):
+        """
+        Stops ffmpeg while it is too far ahead of every reader and continues it
+        when a reader catches up. A stopped ffmpeg gives up its scheduler slot
+        and waits for one again before it continues.
+        """
+        process = self.ffmpeg_process
+        if not self.pause_segments_ahead or process is None or process.transport is None:
+            return
+        
+        furthest_reader_index = self.base_container.get_furthest_reader_index()
+        segments_ahead = len(self.base_container.elements) - 1 - furthest_reader_index
+        should_pause = segments_ahead > self.pause_segments_ahead
+        if furthest_reader_index < 0 and not self.pause_without_readers: # nothing would ever continue it
+            should_pause = False
+        
+        if should_pause:
+            if self.resuming: # the readers went away again before it got a slot
+                scheduler.cancel(process)
+                self.resuming = False
+            elif not self.paused:
+                try:
+                    process.transport.signalProcess('STOP')
+                except error.ProcessExitedAlready:
+                    return
+                self.paused = True
+                scheduler.pause(process)
+        elif self.paused and not self.resuming:
+            self.resuming = True
+            scheduler.resume(process, self._count_waiting_readers).addCallback(self._resume, process)
+    
+    def _resume(self, wait_time, process):
+        if process is not self.ffmpeg_process:
+            return
+        
+        self.resuming = False
+        self.paused = False
+        try:
+            process.transport.signalProcess(signal.SIGCONT) # signalProcess only knows a few signals by name
+        except error.ProcessExitedAlready:
+            pass
+    
+    @defer.inlineCallbacks
     def check_for_files_to_move(self, move_last=True):
-        files = sorted(os.listdir(self.temp_output_path))
+        files = sorted((yield defer_to_io_pool(os.listdir, self.temp_output_path)))
         
         for i, filename in enumerate(files, 1):
-            segment_id = self._get_segment_id_from_filename(filename)
-            filepath = os.path.join(self.temp_output_path, filename)
-            
-            if segment_id is None: # invalid filename, got no segment id, skipping
-                continue 
-            
             if i == len(files) and self.ffmpeg_process is not None: # this is the last file, we cannot move that
                 continue
             
-            result_file = os.path.join(self.output_path, filename)
-            os.rename(filepath, result_file)
-            
-            self.probe_tracks(result_file)
-            
-            if segment_id in self.segment_created_defers:
-                for d in self.segment_created_defers[segment_id]:
-                    d.callback(None)
-                
-                del self.segment_created_defers[segment_id]
-            
-            if self.base_container:
-                size = self._get_segment_size(segment_id)
-                self.base_container.write_element(LazyStringIO(partial(self.get_segment, segment_id, size), size), size)
+            yield self.move_segment(filename)
     
     def start_encoding(self): # 'output-%05d.mkv'
-        self.move_timer.start(1.0)
-        
         cmd = [
-            self.ffmpeg_path, '-i', self.url, '-sn', '-codec', 'copy', '-map', '0',
+            self.ffmpeg_path, '-i', self.input_url, '-sn', '-codec', 'copy', '-map', '0',
             '-c:a', 'aac', '-strict', '-2', '-b:a', '384k',
             '-f', 'segment', '-segment_format', 'mkv',
-            '-segment_time', '10',
-        ]
+            '-segment_list', 'pipe:1', '-segment_list_type', 'flat',
+            '-segment_time', str(SEGMENT_TIME),
+        ] + PROGRESS_ARGS
         
         cmd += [
             os.path.join(self.temp_output_path, OUTPUT_FORMAT),
         ]
         
-        self.ffmpeg_process = FFMpegPP()
+        self.ffmpeg_process = FFMpegPP(self.segment_completed)
+        
+        def spawned(wait_time):
+            self.encode_started = time.time()
         
-        reactor.spawnProcess(self.ffmpeg_process, self.ffmpeg_path, cmd)
+        scheduler.spawn(self.ffmpeg_process, cmd, self._count_waiting_readers, childFDs=PROGRESS_FDS).addCallback(spawned)
         
         def done_encoding(ignored):
             self.ffmpeg_process = None
+            self.paused = self.resuming = False
             self.stop_encoding(successful=True)
         
-        self.ffmpeg_process.finished.addCallback(done_encoding)
+        def failed_encoding(reason):
+            self.ffmpeg_process = None
+            self.paused = self.resuming = False
+        
+        self.ffmpeg_process.finished.addCallbacks(done_encoding, failed_encoding)
     
     @defer.inlineCallbacks
     def probe_tracks(self, filepath):
         if self.file_info is not None and 'Tracks' in self.file_info:
             return
         
-        with open(filepath, 'rb') as f:
-            doc = MatroskaDocument(f)
-            segment = doc.roots[1]
-            
-            self.file_info = yield threads.deferToThread(extract_parts, segment, parts=['Tracks', 'Info'])
+        self.file_info = yield defer_to_io_pool(read_segment_parts, filepath, ['Tracks', 'Info'])
         
         self.check_if_ready_to_stream()
     
     @defer.inlineCallbacks
     def prepare_encode(self):
         yield self.probe()
+        if self.closed:
+            return
         self.start_encoding()
     
+    def _count_waiting_readers(self):
+        count = len(self.container_defers)
+        if self.base_container:
+            count += len(self.base_container.waiters)
+        return count
+    
+    @defer.inlineCallbacks
     def stop_encoding(self, successful=False):
-        self.move_timer.stop()
-        
-        if not successful:
-            self.ffmpeg_process.transport.signalProcess('KILL')
-        
-        self.check_for_files_to_move(move_last=successful)
+        if not successful and self.ffmpeg_process is not None:
+            scheduler.cancel(self.ffmpeg_process) # still queued to start or continue
+            if self.ffmpeg_process.transport is not None:
+                try:
+                    self.ffmpeg_process.transport.signalProcess('KILL')
+                except error.ProcessExitedAlready:
+                    pass
+        
+        yield self.check_for_files_to_move(move_last=successful)
+        
+        if successful: # readers waiting at the end of the file can now be told it is done
+            self.encoding_finished = True
+            if self.base_container:
+                self.base_container.finish()
         
         # Generate cue table here and add it to the container.
\ No newline at end of file
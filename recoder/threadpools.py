@@ -0,0 +1,121 @@
+import threading
+import time
+
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+PROBE_THREADS = 4
+SOURCE_THREADS = 8
+IO_THREADS = 4
+
+class PoolStats(object):
+    """
+    Queue depth and per task latency of the work sent to a thread pool.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.tasks = {} # task name -> [count, total wait time, total run time, max run time]
+
+    def task_queued(self):
+        with self.lock:
+            self.queued += 1
+
+    def task_started(self):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+
+    def task_finished(self, name, wait_time, run_time, failed):
+        with self.lock:
+            self.running -= 1
+            self.completed += 1
+            if failed:
+                self.failed += 1
+
+            task = self.tasks.setdefault(name, [0, 0, 0, 0])
+            task[0] += 1
+            task[1] += wait_time
+            task[2] += run_time
+            task[3] = max(task[3], run_time)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'tasks': dict((name, {
+                    'count': count,
+                    'avg_wait_time': total_wait_time / count,
+                    'avg_run_time': total_run_time / count,
+                    'max_run_time': max_run_time,
+                }) for name, (count, total_wait_time, total_run_time, max_run_time) in self.tasks.items()),
+            }
+
+pool_stats = {} # pool name -> PoolStats
+
+def create_threadpool(minthreads, maxthreads, name):
+    """
+    Creates a thread pool that follows the lifetime of the reactor.
+    """
+    pool = ThreadPool(minthreads, maxthreads, name)
+    pool_stats[name] = PoolStats()
+    reactor.callWhenRunning(pool.start)
+    reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+    return pool
+
+def defer_to_pool(pool, f, *args, **kwargs):
+    """
+    Like deferToThreadPool but records how long f waited and ran.
+    """
+    stats = pool_stats[pool.name]
+    name = getattr(f, '__name__', repr(f))
+    queued = time.time()
+
+    def run():
+        started = time.time()
+        stats.task_started()
+        failed = True
+        try:
+            retval = f(*args, **kwargs)
+            failed = False
+            return retval
+        finally:
+            stats.task_finished(name, started - queued, time.time() - started, failed)
+
+    stats.task_queued()
+    return threads.deferToThreadPool(reactor, pool, run)
+
+def get_stats():
+    return dict((name, stats.get_stats()) for name, stats in pool_stats.items())
+
+probe_pool = create_threadpool(0, PROBE_THREADS, 'recoder-probe')
+
+def defer_to_probe_pool(f, *args, **kwargs):
+    """
+    Run blocking source probing, e.g. fetching and parsing
+    a remote file, without touching the reactor thread.
+    """
+    return defer_to_pool(probe_pool, f, *args, **kwargs)
+
+source_pool = create_threadpool(0, SOURCE_THREADS, 'recoder-source')
+
+def defer_to_source_pool(f, *args, **kwargs):
+    """
+    Run blocking reads from the local source cache and origin.
+    """
+    return defer_to_pool(source_pool, f, *args, **kwargs)
+
+io_pool = create_threadpool(0, IO_THREADS, 'recoder-io')
+
+def defer_to_io_pool(f, *args, **kwargs):
+    """
+    Run blocking work on encoded segments, e.g. moving, indexing
+    and parsing them, without touching the reactor thread.
+    """
+    return defer_to_pool(io_pool, f, *args, **kwargs)
@@ -0,0 +1,120 @@
+import json
+import os
+import sys
+import thread
+import threading
+import time
+import traceback
+
+from twisted.application import service
+from twisted.internet import task
+from twisted.python import log
+from twisted.web import resource
+
+HEARTBEAT_INTERVAL = 0.1
+STALL_THRESHOLD = 0.5
+PACKAGE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+def get_call_site(stack):
+    """
+    The innermost frame from our own code, falls back to the innermost frame.
+    """
+    for filename, lineno, name, line in reversed(stack):
+        if os.path.abspath(filename).startswith(PACKAGE_PATH):
+            filename = os.path.relpath(filename, os.path.dirname(PACKAGE_PATH))
+            break
+    else:
+        filename, lineno, name, line = stack[-1]
+
+    return '%s:%s (%s)' % (filename, lineno, name)
+
+class ReactorWatchdog(service.Service):
+    """
+    Measures how late the reactor runs a heartbeat. When the reactor has not been
+    seen for threshold seconds, a thread captures what the reactor thread is doing
+    and the stall is attributed to that call site when the reactor comes back.
+    """
+    reactor_thread_id = None
+    last_beat = None
+
+    def __init__(self, threshold=STALL_THRESHOLD, interval=HEARTBEAT_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stall_stack = None # stack captured during the current stall
+        self.stalls = {} # call site -> {'count', 'total_time', 'max_time', 'stack'}
+        self.max_lag = 0
+        self.stopped = threading.Event()
+
+    def startService(self):
+        service.Service.startService(self)
+        self.reactor_thread_id = thread.get_ident()
+        self.last_beat = time.time()
+        self.stopped.clear()
+
+        self.heartbeat = task.LoopingCall(self.beat)
+        self.heartbeat.start(self.interval, now=False)
+
+        self.thread = threading.Thread(target=self._watch, name='Reactor watchdog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self.stopped.set()
+        if self.heartbeat.running:
+            self.heartbeat.stop()
+        self.thread.join()
+
+    def beat(self):
+        now = time.time()
+        with self.lock:
+            lag = now - self.last_beat - self.interval
+            self.last_beat = now
+            stack, self.stall_stack = self.stall_stack, None
+
+        self.max_lag = max(self.max_lag, lag)
+        if stack is None or lag < self.threshold:
+            return
+
+        call_site = get_call_site(stack)
+        stall = self.stalls.setdefault(call_site, {'count': 0, 'total_time': 0, 'max_time': 0, 'stack': None})
+        stall['count'] += 1
+        stall['total_time'] += lag
+        stall['max_time'] = max(stall['max_time'], lag)
+        stall['stack'] = ''.join(traceback.format_list(stack))
+
+        log.msg('Reactor stalled for %.3f seconds in %s:\n%s' % (lag, call_site, stall['stack']))
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                if self.stall_stack is not None or time.time() - self.last_beat < self.threshold:
+                    continue
+
+                frame = sys._current_frames().get(self.reactor_thread_id)
+                if frame is not None:
+                    self.stall_stack = traceback.extract_stack(frame)
+                del frame
+
+    def get_stats(self):
+        return {
+            'threshold': self.threshold,
+            'max_lag': self.max_lag,
+            'stalls': self.stalls,
+        }
+
+class WatchdogResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, watchdog):
+        self.watchdog = watchdog
+        resource.Resource.__init__(self)
+
+    def render_GET(self, request):
+        stats = self.watchdog.get_stats()
+        stats['stalls'] = sorted([dict(stall, call_site=call_site) for call_site, stall in stats['stalls'].items()],
+                                 key=lambda stall: stall['total_time'], reverse=True)
+
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(stats, indent=2)
@@ -1,4 +1,4 @@
-from twisted.application import internet
+from twisted.application import internet, service
 from twisted.application.service import IServiceMaker
 from twisted.plugin import IPlugin
 from twisted.python import usage
@@ -8,11 +8,28 @@ from zope.interface import implements
 
 
 class Options(usage.Options):
+    optFlags = [
+        ['allow-local-files', None, "Allow file:// urls and paths as sources"],
+        ['delete-idle-streams', None, "Delete the encoded files of streams closed for being idle"],
+        ['seekable', None, "Remux sources with cue points so readers can seek and the encode restarts where they seek to, instead of streaming them"],
+    ]
     optParameters = [
         ['ffprobe', 'fp', './ffprobe', "Path to ffprobe"],
         ['ffmpeg', 'fm', './ffmpeg', "Path to ffmpeg"],
         ['folder', 'f', './unpack', "Path to store encoded"],
         ['port', 'p', '8888', "Port to listen on"],
+        ['chunk-cache-size', None, str(64*1024*1024), "Bytes of source file chunks to keep in memory"],
+        ['segment-cache-size', None, str(256*1024*1024), "Bytes of encoded segments to keep in memory"],
+        ['source-cache', None, None, "Path to keep a local copy of source files, disabled if not set"],
+        ['source-cache-size', None, str(10*1024*1024*1024), "Bytes of source files to keep on disk, least recently used are removed first, 0 for no limit"],
+        ['encode-workers', None, '1', "Number of ffmpeg processes encoding different parts of a file in parallel, needs --seekable"],
+        ['max-ffmpeg-processes', None, '4', "Number of ffmpeg processes allowed to run at once, the rest are queued"],
+        ['pause-segments-ahead', None, '10', "Pause ffmpeg when it is this many segments ahead of every reader, 0 to disable. Streams without readers only pause with --idle-timeout"],
+        ['idle-timeout', None, '0', "Close streams nobody has read from for this many seconds, 0 to keep them forever"],
+        ['disk-quota', None, '0', "Bytes to keep in the output folder, folders of closed streams then the least recently read segments are removed first, 0 for no limit"],
+        ['retention-segments', None, '0', "Remove segments this many segments behind every reader of a stream, 0 to keep them"],
+        ['io-threads', None, '4', "Number of threads doing blocking work on encoded segments"],
+        ['stall-threshold', None, '0', "Log and report reactor stalls longer than this many seconds on /stalls, 0 to disable"],
     ]
 
 class TidalRecoderServiceMaker(object):
@@ -22,10 +39,44 @@ class TidalRecoderServiceMaker(object):
     options = Options
 
     def makeService(self, options):
+        from recoder.encoder import segment_cache
+        from recoder.httpfile import chunk_cache
         from recoder.main import MainResource
+        from recoder.scheduler import scheduler
+        from recoder.stats import StatsResource
+        from recoder.streamingencoder import StreamingEncoder
+        from recoder.threadpools import io_pool
+        
+        chunk_cache.set_max_size(int(options['chunk-cache-size']))
+        segment_cache.set_max_size(int(options['segment-cache-size']))
+        scheduler.set_max_processes(max(int(options['max-ffmpeg-processes']), 1))
+        StreamingEncoder.pause_segments_ahead = int(options['pause-segments-ahead'])
+        StreamingEncoder.pause_without_readers = int(options['idle-timeout']) > 0
+        io_pool.adjustPoolsize(0, max(int(options['io-threads']), 1))
+        
+        multi_service = service.MultiService()
+        
+        source_caches = None
+        if options['source-cache']:
+            from recoder.sourcecache import SourceCacheManager
+            source_caches = SourceCacheManager(options['source-cache'], int(options['source-cache-size']))
+            source_caches.setServiceParent(multi_service)
+        
+        main_resource = MainResource(options['folder'], options['ffmpeg'], options['ffprobe'], source_caches, options['allow-local-files'],
+                                     int(options['idle-timeout']), options['delete-idle-streams'],
+                                     int(options['disk-quota']), int(options['retention-segments']), options['seekable'],
+                                     max(int(options['encode-workers']), 1))
+        main_resource.putChild('stats', StatsResource(main_resource))
+        
+        if float(options['stall-threshold']):
+            from recoder.watchdog import ReactorWatchdog, WatchdogResource
+            watchdog = ReactorWatchdog(float(options['stall-threshold']))
+            watchdog.setServiceParent(multi_service)
+            main_resource.putChild('stalls', WatchdogResource(watchdog))
         
-        site = server.Site(MainResource(options['folder'], options['ffmpeg'], options['ffprobe']))
+        site = server.Site(main_resource)
+        internet.TCPServer(int(options['port']), site).setServiceParent(multi_service)
         
-        return internet.TCPServer(int(options['port']), site)
+        return multi_service
 
 serviceMaker = TidalRecoderServiceMaker()